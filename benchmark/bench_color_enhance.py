@@ -0,0 +1,46 @@
+import random
+import timeit
+import numpy as np
+from PIL import Image, ImageEnhance
+from dataset.augment import colorEnhance
+
+
+# Reference chain of four ImageEnhance passes that colorEnhance replaced
+def colorEnhance_pil(image, factors=None):
+    bright, contrast, color, sharp = factors or (random.randint(5, 15), random.randint(5, 15),
+                                                 random.randint(0, 20), random.randint(0, 30))
+    image = ImageEnhance.Brightness(image).enhance(bright / 10.0)
+    image = ImageEnhance.Contrast(image).enhance(contrast / 10.0)
+    image = ImageEnhance.Color(image).enhance(color / 10.0)
+    image = ImageEnhance.Sharpness(image).enhance(sharp / 10.0)
+    return image
+
+
+class FixedDraws(object):
+    def __init__(self, factors):
+        self.factors = list(factors)
+
+    def integers(self, low, high):
+        return self.factors.pop(0)
+
+
+def bench(name, fn, image, number):
+    cost = timeit.timeit(lambda: fn(image), number=number) / number
+    print('{:<22s} {:10.3f} ms/sample'.format(name, cost * 1000))
+    return cost
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_color_enhance
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (384, 384, 3), dtype=np.uint8))
+    errors = []
+    for _ in range(50):
+        factors = (rng.integers(5, 16), rng.integers(5, 16), rng.integers(0, 21), rng.integers(0, 31))
+        ref = np.asarray(colorEnhance_pil(image, factors), dtype=np.float64)
+        out = np.asarray(colorEnhance(image, rng=FixedDraws(factors)), dtype=np.float64)
+        errors.append(np.abs(ref - out).mean())
+    print('mean abs diff to PIL {:.3f} (0-255)'.format(np.mean(errors)))
+    pil = bench('colorEnhance (PIL)', colorEnhance_pil, image, 100)
+    fused = bench('colorEnhance', colorEnhance, image, 100)
+    print('speedup x{:.1f}'.format(pil / fused))
@@ -0,0 +1,43 @@
+import os
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from dataset.dataloader import draft_rgb_loader
+
+
+def full_loader(path, size):
+    with open(path, 'rb') as f:
+        return Image.open(f).convert('RGB')
+
+
+def bench_root(root, size, number):
+    names = sorted(n for n in os.listdir(root) if n.lower().endswith('.jpg'))[:number]
+    paths = [os.path.join(root, n) for n in names]
+    costs, errors, scales = {}, [], []
+    for name, loader in [('full', full_loader), ('draft', draft_rgb_loader)]:
+        start = time.perf_counter()
+        outputs = [loader(p, size).resize((size, size), Image.BILINEAR) for p in paths]
+        costs[name] = (time.perf_counter() - start) / max(len(paths), 1)
+        if name == 'full':
+            reference = outputs
+    for path, ref, out in zip(paths, reference, outputs):
+        errors.append(np.abs(np.asarray(ref, dtype=np.float64) - np.asarray(out, dtype=np.float64)).mean())
+        with Image.open(path) as img:
+            w = img.size[0]
+        scales.append(w / draft_rgb_loader(path, size).size[0])
+    print('{:<40s} {:5d} jpgs  full {:7.2f} ms  draft {:7.2f} ms  x{:.1f}  mean scale 1/{:.1f}  '
+          'mean abs diff {:.2f}'.format(root[-40:], len(paths), costs['full'] * 1000, costs['draft'] * 1000,
+                                        costs['full'] / max(costs['draft'], 1e-9), np.mean(scales),
+                                        np.mean(errors)))
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_decode --roots <COD10K/Imgs> <DUT-OMRON/Imgs> ...
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roots', nargs='+', required=True, help='image folders, one per dataset')
+    parser.add_argument('--size', type=int, default=384)
+    parser.add_argument('--number', type=int, default=200, help='images per dataset')
+    args = parser.parse_args()
+    for root in args.roots:
+        bench_root(root, args.size, args.number)
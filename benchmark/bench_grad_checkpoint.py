@@ -0,0 +1,110 @@
+import time
+import json
+import resource
+import argparse
+import subprocess
+import sys
+import torch
+import torch.nn as nn
+from model.backbone.swin import SwinTransformer
+from model.neck.get_neck import get_neck
+from model.decoder.get_decoder import get_decoder
+from model.blocks.grad_checkpoint import checkpoint_features
+
+
+# name -> grad_ckpt setting, as param['grad_ckpt'] in config.py
+SETTINGS = {
+    'none': {'backbone': [False, False, False, False], 'neck': False, 'decoder': False},
+    'stage3': {'backbone': [False, False, True, False], 'neck': False, 'decoder': False},
+    'stages1-3': {'backbone': [True, True, True, False], 'neck': False, 'decoder': False},
+    'backbone': {'backbone': [True, True, True, True], 'neck': False, 'decoder': False},
+    'all': {'backbone': [True, True, True, True], 'neck': True, 'decoder': True},
+}
+
+
+class SwinSOD(nn.Module):
+    """Backbone + neck + decoder of sod_model, without the pretrained weights."""
+    def __init__(self, option):
+        super(SwinSOD, self).__init__()
+        self.backbone = SwinTransformer(img_size=option['trainsize'], embed_dim=128, depths=[2, 2, 18, 2],
+                                        num_heads=[4, 8, 16, 32], window_size=12,
+                                        use_checkpoint=option['grad_ckpt']['backbone'])
+        self.neck = get_neck(option, [128, 256, 512, 1024])
+        self.decoder = get_decoder(option)
+        self.grad_ckpt = option['grad_ckpt']
+
+    def forward(self, img):
+        neck_features = checkpoint_features(self.neck, self.backbone(img), self.grad_ckpt['neck'])
+        return checkpoint_features(self.decoder, neck_features, self.grad_ckpt['decoder'])
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10   # KB on linux
+
+
+def run_setting(args, name):
+    device = torch.device(args.device)
+    option = {'trainsize': args.size, 'neck': args.neck, 'decoder': args.decoder, 'neck_channel': args.neck_channel,
+              'deep_sup': True, 'grad_ckpt': SETTINGS[name]}
+    torch.manual_seed(0)
+    model = SwinSOD(option).to(device).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    images = torch.randn(args.batch_size, 3, args.size, args.size, device=device)
+    gts = torch.rand(args.batch_size, 1, args.size, args.size, device=device)
+
+    def step():
+        optimizer.zero_grad()
+        preds = model(images)
+        loss = sum(nn.functional.binary_cross_entropy_with_logits(p, gts) for p in preds)
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    step()   # warmup, also allocates the optimizer state
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(args.number):
+        step()
+    cost = (time.perf_counter() - start) / args.number
+    # CPU: process max RSS, the model / optimizer state is included in both numbers
+    return {'name': name, 'time': cost, 'peak': peak_memory_mb(device)}
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_grad_checkpoint --batch_size 12 --size 384
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=384)
+    parser.add_argument('--batch_size', type=int, default=12)
+    parser.add_argument('--number', type=int, default=3)
+    parser.add_argument('--neck', default='basic')
+    parser.add_argument('--decoder', default='cat')
+    parser.add_argument('--neck_channel', type=int, default=32)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--settings', nargs='+', default=list(SETTINGS.keys()), choices=list(SETTINGS.keys()))
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(run_setting(args, args.worker)))
+        sys.exit(0)
+
+    # One process per setting, so that every peak memory is measured from a clean allocator / RSS
+    print('[INFO] Swin-B + {} neck + {} decoder, batch {} at {}x{} on {}'.format(
+        args.neck, args.decoder, args.batch_size, args.size, args.size, args.device))
+    results = []
+    for name in args.settings:
+        command = [sys.executable, '-m', 'benchmark.bench_grad_checkpoint', '--worker', name]
+        for key in ['size', 'batch_size', 'number', 'neck', 'decoder', 'neck_channel', 'device']:
+            command += ['--' + key, str(getattr(args, key))]
+        output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    reference = results[0]
+    for r in results:
+        print('{:<10s} {:>5s}: {}  peak {:8.0f} MB ({:+6.1f}%)  step {:8.1f} ms ({:+6.1f}%)'.format(
+            r['name'], 'gpu' if args.device.startswith('cuda') else 'rss', json.dumps(SETTINGS[r['name']]),
+            r['peak'], 100 * (r['peak'] / reference['peak'] - 1), r['time'] * 1000,
+            100 * (r['time'] / reference['time'] - 1)))
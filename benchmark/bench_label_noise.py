@@ -0,0 +1,43 @@
+import random
+import timeit
+import numpy as np
+from PIL import Image
+from dataset.augment import randomPeper, randomGaussian
+
+
+# Reference per-pixel implementations that randomPeper / randomGaussian replaced
+def randomPeper_loop(img):
+    img = np.array(img)
+    noiseNum = int(0.0015 * img.shape[0] * img.shape[1])
+    for i in range(noiseNum):
+        randX = random.randint(0, img.shape[0] - 1)
+        randY = random.randint(0, img.shape[1] - 1)
+        if random.randint(0, 1) == 0:
+            img[randX, randY] = 0
+        else:
+            img[randX, randY] = 255
+    return Image.fromarray(img)
+
+
+def randomGaussian_loop(image, mean=0.1, sigma=0.35):
+    img = np.asarray(image).flatten().astype(np.float64)
+    for _i in range(len(img)):
+        img[_i] += random.gauss(mean, sigma)
+    return Image.fromarray(np.uint8(np.clip(img, 0, 255).reshape(np.asarray(image).shape)))
+
+
+def bench(name, fn, gt, number):
+    cost = timeit.timeit(lambda: fn(gt), number=number) / number
+    print('{:<22s} {:10.3f} ms/sample'.format(name, cost * 1000))
+    return cost
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_label_noise
+    gt = Image.fromarray((np.random.rand(384, 384) > 0.5).astype(np.uint8) * 255)
+    loop = bench('randomPeper (loop)', randomPeper_loop, gt, 200)
+    vec = bench('randomPeper', randomPeper, gt, 200)
+    print('speedup x{:.1f}'.format(loop / vec))
+    loop = bench('randomGaussian (loop)', randomGaussian_loop, gt, 3)
+    vec = bench('randomGaussian', randomGaussian, gt, 50)
+    print('speedup x{:.1f}'.format(loop / vec))
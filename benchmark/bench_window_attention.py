@@ -0,0 +1,53 @@
+import time
+import argparse
+import torch
+from model.backbone.swin import BasicLayer
+
+
+def bench_stage(layer, x, H, W, number, train):
+    layer.train(train)
+    for _ in range(2):   # warmup, fills the mask / bias caches
+        run(layer, x, H, W, train)
+    start = time.perf_counter()
+    for _ in range(number):
+        run(layer, x, H, W, train)
+    return (time.perf_counter() - start) / number
+
+
+def run(layer, x, H, W, train):
+    if train:
+        out, _, _ = layer(x.requires_grad_(), H, W)
+        out.square().mean().backward()
+    else:
+        with torch.no_grad():
+            layer(x, H, W)
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_window_attention --batch_size 2
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=384, help='input size, stage 3 runs at size / 16')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--number', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    # Stage 3 of the swin-base backbone: 18 blocks, dim 512, 16 heads, window 12
+    H = W = args.size // 16
+    torch.manual_seed(0)
+    layers = {}
+    for fused in [False, True]:
+        torch.manual_seed(0)
+        layers[fused] = BasicLayer(dim=512, depth=18, num_heads=16, window_size=12, drop_path=0., fused_attn=fused)
+    x = torch.randn(args.batch_size, H * W, 512)
+    with torch.no_grad():
+        diff = (layers[False].eval()(x, H, W)[0] - layers[True].eval()(x, H, W)[0]).abs().max().item()
+    print('[INFO] Stage 3 at {}x{} ({}x{} tokens), batch {}, {} threads, max abs diff {:.2e}'.format(
+        args.size, args.size, H, W, args.batch_size, torch.get_num_threads(), diff))
+    for train in [False, True]:
+        costs = {fused: bench_stage(layer, x.clone(), H, W, args.number, train) for fused, layer in layers.items()}
+        print('{:<22s} eager {:8.1f} ms  sdpa {:8.1f} ms  x{:.2f}'.format(
+            'train fwd+bwd' if train else 'eval fwd (no_grad)', costs[False] * 1000, costs[True] * 1000,
+            costs[False] / costs[True]))
@@ -0,0 +1,81 @@
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from model.backbone.swin import window_partition, window_reverse, get_window_layout, get_window_index
+
+
+def reference_windows(x, H, W, window_size, shift_size):
+    # pad -> cyclic shift -> window_partition, as SwinTransformerBlock did before the gather maps
+    B, _, C = x.shape
+    _, _, Hp, Wp = get_window_layout(H, W, window_size, shift_size)
+    x = F.pad(x.view(B, H, W, C), (0, 0, 0, Wp - W, 0, Hp - H))
+    if shift_size > 0:
+        x = torch.roll(x, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    return window_partition(x, window_size).view(-1, window_size * window_size, C)
+
+
+def reference_merge(windows, H, W, window_size, shift_size):
+    # window_reverse -> reverse cyclic shift -> crop
+    _, _, Hp, Wp = get_window_layout(H, W, window_size, shift_size)
+    C = windows.shape[-1]
+    x = window_reverse(windows.view(-1, window_size, window_size, C), window_size, Hp, Wp)
+    if shift_size > 0:
+        x = torch.roll(x, shifts=(shift_size, shift_size), dims=(1, 2))
+    return x[:, :H, :W, :].contiguous().view(-1, H * W, C)
+
+
+def gather_windows(x, H, W, window_size, shift_size):
+    B, _, C = x.shape
+    _, _, Hp, Wp = get_window_layout(H, W, window_size, shift_size)
+    if Hp != H or Wp != W:
+        x = F.pad(x.view(B, H, W, C), (0, 0, 0, Wp - W, 0, Hp - H)).view(B, Hp * Wp, C)
+    index, _ = get_window_index(H, W, window_size, shift_size, x.device)
+    if index is not None:
+        x = x.index_select(1, index)
+    return x.view(-1, window_size * window_size, C)
+
+
+def gather_merge(windows, H, W, window_size, shift_size):
+    _, _, Hp, Wp = get_window_layout(H, W, window_size, shift_size)
+    _, inverse = get_window_index(H, W, window_size, shift_size, windows.device)
+    x = windows.view(-1, Hp * Wp, windows.shape[-1])
+    return x if inverse is None else x.index_select(1, inverse)
+
+
+def timeit(fn, number):
+    fn()
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+if __name__ == '__main__':
+    # python -m benchmark.bench_window_gather --device cpu
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    # swin-base stages (dim, window 12) at square, bucketed and low resolution inputs
+    for size in [(384, 384), (320, 448), (256, 256), (224, 352)]:
+        H, W = size[0] // 4, size[1] // 4
+        for dim in [128, 256, 512, 1024]:
+            x = torch.randn(args.batch_size, H * W, dim, device=args.device)
+            for shift in [0, 6]:
+                window_size, shift_size, _, _ = get_window_layout(H, W, 12, shift)
+                windows = reference_windows(x, H, W, window_size, shift_size)
+                exact = torch.equal(windows, gather_windows(x, H, W, window_size, shift_size))
+                merged = reference_merge(windows, H, W, window_size, shift_size)
+                exact = exact and torch.equal(merged, gather_merge(windows, H, W, window_size, shift_size))
+                exact = exact and torch.equal(merged, x)
+                ref = timeit(lambda: reference_merge(reference_windows(x, H, W, window_size, shift_size),
+                                                     H, W, window_size, shift_size), args.number)
+                new = timeit(lambda: gather_merge(gather_windows(x, H, W, window_size, shift_size),
+                                                  H, W, window_size, shift_size), args.number)
+                print('{:>3d}x{:<3d} dim {:4d} window {:2d} shift {}  bit-exact {}  roll/partition {:7.2f} ms  '
+                      'gather {:7.2f} ms  x{:.2f}'.format(H, W, dim, window_size, shift_size, exact,
+                                                         ref * 1000, new * 1000, ref / new))
+            H, W = (H + 1) // 2, (W + 1) // 2
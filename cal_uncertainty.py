@@ -1,3 +1,4 @@
+# Offline uncertainty maps from saved 8-bit predictions, test.py now writes them directly (Tester.forward_samples)
 from tqdm import tqdm
 import numpy as np
 import cv2
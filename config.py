@@ -38,6 +38,11 @@ param['trainsize'] = 384
 param['optim'] = "AdamW"
 param['loss'] = 'weak' if param['task']=='Weak-RGB-SOD' else 'structure'
 param['size_rates'] = [1] 
+param['device_augment'] = False   # augment collated uint8 batches on the training device instead of in workers
+param['uint8_input'] = False   # loaders emit uint8 images, Normalize is folded into the first backbone layer
+param['loader_autotune'] = False   # time workers / prefetch / pinning once per host and dataset, cached in ~/.cache
+param['shard_root'] = None   # stream training data from tar shards written by `python -m dataset.shards`
+param['aspect_buckets'] = False   # batch samples by aspect ratio into (H, W) buckets of ~trainsize**2 pixels
 
 ## Model Config
 # RGB Model
@@ -46,6 +51,18 @@ param['deep_sup'] = True
 param['neck_channel'] = args.neck_channel
 param['backbone'] = args.backbone
 param['decoder'] = args.decoder
+param['fused_attn'] = True   # swin window attention through F.scaled_dot_product_attention (torch >= 2.0), else eager
+# Activation checkpointing (recompute in backward) to fit larger batches / resolutions, per swin stage plus
+# neck and decoder, see `python -m benchmark.bench_grad_checkpoint` for the memory / step time tradeoff
+param['grad_ckpt'] = {'backbone': [False, False, False, False], 'neck': False, 'decoder': False}
+# Mixed precision training (trainer/amp.py): fp16 autocast + GradScaler on CUDA, bf16 autocast on CPU,
+# the losses and the vae KL stay in fp32
+param['amp'] = False
+param['grad_accum'] = 1   # optimizer step every N micro steps (batches x size_rates), N times the effective batch
+param['compile'] = False   # torch.compile the models in place (torch >= 2.2), the first steps are slow
+# Training visualization every N steps and / or T seconds (0 disables either), written by a background thread
+# to log_path/vis_temp, or to TensorBoard images with tensorboard=True
+param['vis_config'] = {'every_steps': 100, 'every_seconds': 0, 'tensorboard': False}
 # Depth Model
 param['fusion'] = args.fusion   # [early, late, cross, rgb, aux]
 param['fusion_method'] = 'refine'
@@ -54,13 +71,20 @@ param['fusion_method'] = 'refine'
 param['uncer_method'] = args.uncer_method   # gan, vae, abp, ebm
 param['vae_config'] = {'reg_weight': 1e-4, 'lat_weight': 1, 'vae_loss_weight': 0.4, 'latent_dim': 8}
 param['gan_config'] = {'pred_label': 0, 'gt_label': 1, 'latent_dim': 32}
-param['abp_config'] = {'step_num': 5, 'sigma_gen': 0.3, 'langevin_s': 0.1, 'latent_dim': 32}
+# the per-sample latents persist across epochs (log_path/abp_latents.npy, saved with the checkpoints), batches
+# whose latents all come from an earlier epoch run warm_step_num Langevin steps, lower than step_num to opt in
+# (faster, changes the training results)
+param['abp_config'] = {'step_num': 5, 'warm_step_num': 5, 'sigma_gen': 0.3, 'langevin_s': 0.1, 'latent_dim': 32}
 param['ebm_config'] = {'ebm_out_dim': 1, 'ebm_middle_dim': 100, 'latent_dim': 32, 'e_init_sig': 1.0, 
                        'e_l_steps': 5, 'e_l_step_size': 0.4, 'e_prior_sig': 1.0, 'g_l_steps': 5,
                        'g_llhd_sigma': 0.3, 'g_l_step_size': 0.1, 'e_energy_form': 'identity'}
 param['ganabp_config'] = {'pred_label': 0, 'gt_label': 1, 'step_num': 5, 'sigma_gen': 0.3, 
                           'langevin_s': 0.1, 'latent_dim': 18, 'lamda_dis': args.lamda_dis}
 param['basic_config'] = {'latent_dim': 32}   # Just for placeholder!!!
+# shared by the abp / ganabp / ebm Langevin chains: after min_steps a sample stops once its relative energy change
+# is below energy_tol or its gradient norm below grad_tol, max_steps caps every chain (None: no cap). Early stopping
+# is opt-in (0 disables): the energy change is mostly injected noise, so it truncates the posterior for speed
+param['langevin'] = {'min_steps': 2, 'energy_tol': 0, 'grad_tol': 0, 'max_steps': None}
 param['latent_dim'] = param['{}_config'.format(param['uncer_method'])]['latent_dim']
 ##### uncertainty configs [work in process] #####
 
@@ -90,11 +114,15 @@ if args.training_path is not None:
     param['paths']['gt_root'] = os.path.join(args.training_path, 'gt/')
 
 # Test Config
-param['testsize'] = 384
+param['testsize'] = 384   # any multiple of 32 with the swin backbone, e.g. 256 or 320 for faster inference
+param['test_batch_size'] = 8
+param['test_samples'] = 10   # latent draws per image for gan / abp / ganabp / vae, aggregated in memory
+param['test_sample_batch'] = 10   # draws decoded per backbone / neck pass, lower it to bound the decoder memory
+param['save_float16'] = False   # also save [mean, variance, entropy] maps as float16 .npy next to the uncertainty PNGs
 if args.ckpt is not None:
     if args.ckpt.lower() == 'last':
         model_path = os.path.join(param['log_path'], 'models')
-        model_list = os.listdir(model_path)
+        model_list = [name for name in os.listdir(model_path) if name.endswith('.pth')]   # not the ABP latents
         model_list.sort(key=lambda x:int(x.split('_')[0]))
         if 'generator' in model_list[-1]:
             param['checkpoint'] = os.path.join(model_path, model_list[-1])
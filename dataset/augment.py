@@ -1,138 +1,142 @@
+import cv2
 from PIL import Image
+import torch
 import torch.utils.data as data
-import random
 import numpy as np
-from PIL import ImageEnhance
 
 
-# several data augumentation strategies
-def cv_random_flip_rgb(img, label):
-    flip_flag = random.randint(0, 1)
-    if flip_flag == 1:
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        label = label.transpose(Image.FLIP_LEFT_RIGHT)
-    return img, label
-
-
-def randomCrop_rgb(image, label):
-    border = 30
-    image_width = image.size[0]
-    image_height = image.size[1]
-    crop_win_width = np.random.randint(image_width - border, image_width)
-    crop_win_height = np.random.randint(image_height - border, image_height)
-    random_region = (
-        (image_width - crop_win_width) >> 1, (image_height - crop_win_height) >> 1, (image_width + crop_win_width) >> 1,
-        (image_height + crop_win_height) >> 1)
-    return image.crop(random_region), label.crop(random_region)
-
-
-def randomRotation_rgb(image, label):
-    mode = Image.BICUBIC
-    if random.random() > 0.8:
-        random_angle = np.random.randint(-15, 15)
-        image = image.rotate(random_angle, mode)
-        label = label.rotate(random_angle, mode)
-    return image, label
-
-
-def cv_random_flip_rgbd(img, label, depth):
-    flip_flag = random.randint(0, 1)
-    if flip_flag == 1:
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        label = label.transpose(Image.FLIP_LEFT_RIGHT)
-        depth = depth.transpose(Image.FLIP_LEFT_RIGHT)
-    return img, label, depth
-
-
-def randomCrop_rgbd(image, label, depth):
-    border = 30
-    image_width = image.size[0]
-    image_height = image.size[1]
-    crop_win_width = np.random.randint(image_width - border, image_width)
-    crop_win_height = np.random.randint(image_height - border, image_height)
-    random_region = (
-        (image_width - crop_win_width) >> 1, (image_height - crop_win_height) >> 1, (image_width + crop_win_width) >> 1,
-        (image_height + crop_win_height) >> 1)
-    return image.crop(random_region), label.crop(random_region), depth.crop(random_region)
-
-
-def randomRotation_rgbd(image, label, depth):
-    mode = Image.BICUBIC
-    if random.random() > 0.8:
-        random_angle = np.random.randint(-15, 15)
-        image = image.rotate(random_angle, mode)
-        label = label.rotate(random_angle, mode)
-        depth = depth.rotate(random_angle, mode)
-    return image, label, depth
+_rng = None
+
+
+def seed_worker(worker_id):
+    # DataLoader worker_init_fn, torch.initial_seed() differs per worker and per epoch
+    global _rng
+    _rng = np.random.default_rng(torch.initial_seed() % 2**32)
+
+
+def get_rng():
+    global _rng
+    if _rng is None:   # main process (num_workers=0), follows the np.random seed set by set_seed
+        _rng = np.random.default_rng(np.random.randint(2**31))
+    return _rng
 
 
 # several data augumentation strategies
-def cv_random_flip_weak(img, label, mask, gray):
-    flip_flag = random.randint(0, 1)
-    if flip_flag == 1:
-        img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        label = label.transpose(Image.FLIP_LEFT_RIGHT)
-        mask = mask.transpose(Image.FLIP_LEFT_RIGHT)
-        gray = gray.transpose(Image.FLIP_LEFT_RIGHT)
-    return img, label, mask, gray
-
-
-def randomCrop_weak(image, label, mask, gray):
-    border = 30
-    image_width = image.size[0]
-    image_height = image.size[1]
-    crop_win_width = np.random.randint(image_width - border, image_width)
-    crop_win_height = np.random.randint(image_height - border, image_height)
-    random_region = (
-        (image_width - crop_win_width) >> 1, (image_height - crop_win_height) >> 1, (image_width + crop_win_width) >> 1,
-        (image_height + crop_win_height) >> 1)
-    return image.crop(random_region), label.crop(random_region), mask.crop(random_region), gray.crop(random_region)
-
-
-def randomRotation_weak(image, label, mask, gray):
-    mode = Image.BICUBIC
-    if random.random() > 0.8:
-        random_angle = np.random.randint(-15, 15)
-        image = image.rotate(random_angle, mode)
-        label = label.rotate(random_angle, mode)
-        mask = mask.rotate(random_angle, mode)
-        gray = gray.rotate(random_angle, mode)
-    return image, label, mask, gray
-
-
-def colorEnhance(image):
-    bright_intensity = random.randint(5, 15) / 10.0
-    image = ImageEnhance.Brightness(image).enhance(bright_intensity)
-    contrast_intensity = random.randint(5, 15) / 10.0
-    image = ImageEnhance.Contrast(image).enhance(contrast_intensity)
-    color_intensity = random.randint(0, 20) / 10.0
-    image = ImageEnhance.Color(image).enhance(color_intensity)
-    sharp_intensity = random.randint(0, 30) / 10.0
-    image = ImageEnhance.Sharpness(image).enhance(sharp_intensity)
-    return image
-
-
-def randomGaussian(image, mean=0.1, sigma=0.35):
-    def gaussianNoisy(im, mean=mean, sigma=sigma):
-        for _i in range(len(im)):
-            im[_i] += random.gauss(mean, sigma)
-        return im
-
-    img = np.asarray(image)
-    width, height = img.shape
-    img = gaussianNoisy(img[:].flatten(), mean, sigma)
-    img = img.reshape([width, height])
-    return Image.fromarray(np.uint8(img))
-
-
-def randomPeper(img):
+PLANE_RESAMPLE = {'image': Image.BILINEAR, 'gt': Image.NEAREST, 'depth': Image.BILINEAR,
+                  'mask': Image.NEAREST, 'gray': Image.BILINEAR}
+
+
+def random_affine_params(width, height, rng=None, border=30):
+    """Draw the random flip / center crop / rotation of one sample."""
+    rng = rng or get_rng()
+    flip = int(rng.integers(0, 2))
+    crop_win_width = int(rng.integers(width - border, width))
+    crop_win_height = int(rng.integers(height - border, height))
+    crop_region = ((width - crop_win_width) >> 1, (height - crop_win_height) >> 1,
+                   (width + crop_win_width) >> 1, (height + crop_win_height) >> 1)
+    angle = int(rng.integers(-15, 15)) if rng.random() > 0.8 else 0
+    return {'flip': flip, 'crop': crop_region, 'angle': angle}
+
+
+def affine_matrix(width, height, params, out_size):
+    """3x3 matrix mapping output coordinates to source coordinates of a (width, height) plane.
+
+    Equivalent to flip -> crop -> rotate (PIL convention, around the crop center) -> resize to out_size,
+    in continuous pixel coordinates (pixel centers at +0.5).
+    """
+    out_w, out_h = (out_size, out_size) if isinstance(out_size, int) else out_size
+    left, top, right, bottom = params['crop']
+    crop_w, crop_h = right - left, bottom - top
+    resize = np.array([[crop_w / out_w, 0, 0], [0, crop_h / out_h, 0], [0, 0, 1]])
+    a = -np.deg2rad(params['angle'])
+    cx, cy = crop_w / 2.0, crop_h / 2.0
+    rotate = np.array([[np.cos(a), np.sin(a), cx - np.cos(a) * cx - np.sin(a) * cy],
+                       [-np.sin(a), np.cos(a), cy + np.sin(a) * cx - np.cos(a) * cy],
+                       [0, 0, 1]])
+    crop = np.array([[1, 0, left], [0, 1, top], [0, 0, 1]])
+    flip = np.array([[-1, 0, width], [0, 1, 0], [0, 0, 1]]) if params['flip'] else np.eye(3)
+    return flip @ crop @ rotate @ resize
+
+
+def warp_plane(plane, matrix, ref_size, out_size, resample):
+    # Planes decoded at a reduced scale (JPEG draft) are mapped back onto the reference grid
+    scale = np.diag([plane.size[0] / ref_size[0], plane.size[1] / ref_size[1], 1])
+    matrix = scale @ matrix
+    # Large downscales: box-reduce first so that bilinear sampling does not alias
+    factor = int(np.sqrt(abs(np.linalg.det(matrix[:2, :2]))))
+    if factor >= 2 and resample != Image.NEAREST:
+        plane = plane.reduce(factor)
+        matrix = np.diag([1.0 / factor, 1.0 / factor, 1]) @ matrix
+    out_size = (out_size, out_size) if isinstance(out_size, int) else out_size
+    return plane.transform(out_size, Image.AFFINE, data=tuple(matrix[:2].flatten()), resample=resample)
+
+
+def randomAffine(planes, resamples, out_size, rng=None):
+    """Random flip + crop + rotation + resize of N aligned planes, resampling every plane once.
+
+    Args:
+        planes (list[PIL.Image]): aligned planes, e.g. [image, gt, depth]
+        resamples (list[int]): PIL resample filter of every plane, see PLANE_RESAMPLE
+        out_size (int | tuple[int]): output (w, h)
+    """
+    ref_size = (max(p.size[0] for p in planes), max(p.size[1] for p in planes))
+    params = random_affine_params(*ref_size, rng=rng)
+    matrix = affine_matrix(*ref_size, params, out_size)
+    return [warp_plane(p, matrix, ref_size, out_size, r) for p, r in zip(planes, resamples)]
+
+
+LUMA = np.array([0.299, 0.587, 0.114])   # ITU-R 601-2, as PIL's convert('L')
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13   # ImageFilter.SMOOTH
+
+
+def colorEnhance(image, rng=None):
+    """Fused ImageEnhance Brightness -> Contrast -> Color -> Sharpness with the original parameter ranges.
+
+    Brightness and contrast are one 256-entry LUT, saturation is one 3x3 color matrix and sharpness
+    is one 3x3 convolution, all on uint8 with saturation between the stages as in PIL.
+    """
+    rng = rng or get_rng()
+    bright_intensity = rng.integers(5, 16) / 10.0
+    contrast_intensity = rng.integers(5, 16) / 10.0
+    color_intensity = rng.integers(0, 21) / 10.0
+    sharp_intensity = rng.integers(0, 31) / 10.0
+
+    # Contrast blends against the mean luma of the brightened image, taken from the channel histograms
+    levels = np.arange(256)
+    bright_lut = np.clip(np.floor(levels * bright_intensity), 0, 255)
+    hist = np.asarray(image.histogram(), dtype=np.float64).reshape(3, 256)
+    mean = int(np.dot(LUMA, (hist * bright_lut).sum(1) / hist[0].sum()) + 0.5)
+    lut = np.clip(np.floor(mean + contrast_intensity * (bright_lut - mean)), 0, 255).astype(np.uint8)
+    img = cv2.LUT(np.asarray(image), lut)
+
+    # gray + k * (img - gray) == (k * I + (1 - k) * 1 LUMA^T) img, the -0.5 offset turns rounding into truncation
+    color_matrix = np.zeros((3, 4), dtype=np.float32)
+    color_matrix[:, :3] = color_intensity * np.eye(3) + (1 - color_intensity) * LUMA[None, :]
+    color_matrix[:, 3] = -0.5
+    img = cv2.transform(img, color_matrix)
+
+    # blur + k * (img - blur) folded into a single kernel, borders are left untouched as in PIL
+    kernel = (1 - sharp_intensity) * SMOOTH_KERNEL
+    kernel[1, 1] += sharp_intensity
+    out = cv2.filter2D(img, -1, kernel, delta=-0.5)
+    out[0], out[-1], out[:, 0], out[:, -1] = img[0], img[-1], img[:, 0], img[:, -1]
+
+    return Image.fromarray(out)
+
+
+def randomGaussian(image, mean=0.1, sigma=0.35, rng=None):
+    rng = rng or get_rng()
+    img = np.asarray(image, dtype=np.float32)
+    img = img + rng.normal(mean, sigma, size=img.shape).astype(np.float32)
+    # uint8 truncation of the per-pixel loop, without its wrap-around
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def randomPeper(img, rng=None):
+    rng = rng or get_rng()
     img = np.array(img)
     noiseNum = int(0.0015 * img.shape[0] * img.shape[1])
-    for i in range(noiseNum):
-        randX = random.randint(0, img.shape[0] - 1)
-        randY = random.randint(0, img.shape[1] - 1)
-        if random.randint(0, 1) == 0:
-            img[randX, randY] = 0
-        else:
-            img[randX, randY] = 255
+    randX = rng.integers(0, img.shape[0], size=noiseNum)
+    randY = rng.integers(0, img.shape[1], size=noiseNum)
+    img[randX, randY] = rng.integers(0, 2, size=noiseNum, dtype=np.uint8) * 255
     return Image.fromarray(img)
@@ -0,0 +1,126 @@
+import torch
+import numpy as np
+import torch.nn.functional as F
+from utils import IMAGE_MEAN, IMAGE_STD
+from dataset.augment import random_affine_params, affine_matrix, PLANE_RESAMPLE
+
+
+LABELS_NEAREST = ['gt', 'mask']
+LABELS_BILINEAR = ['depth', 'gray']
+
+
+def to_uint8_sample(planes, out_size, index):
+    """Worker side of the on-device augmentation: decode only, resize to a fixed size, keep uint8."""
+    sample = {}
+    out_size = (out_size, out_size) if isinstance(out_size, int) else tuple(out_size)
+    # The image may be draft-decoded at a reduced size, the labels keep the source resolution
+    ref_size = max(plane.size for plane in planes.values())
+    for name, plane in planes.items():
+        array = np.array(plane.resize(out_size, PLANE_RESAMPLE[name]), dtype=np.uint8)
+        tensor = torch.from_numpy(array)
+        sample[name] = tensor.permute(2, 0, 1).contiguous() if tensor.dim() == 3 else tensor.unsqueeze(0)
+    sample['index'] = index
+    sample['size'] = torch.tensor(ref_size)   # source (w, h), crops and rotations are defined on it
+
+    return sample
+
+
+def gray_scale(x):
+    # ITU-R 601-2 luma, as PIL's convert('L')
+    return 0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3]
+
+
+def batch_color_enhance(x, bright, contrast, color, sharp):
+    """Batched ImageEnhance Brightness -> Contrast -> Color -> Sharpness on [0, 1] images (B, 3, H, W)."""
+    x = (x * bright).clamp(0, 1)
+    mean = gray_scale(x).mean(dim=(1, 2, 3), keepdim=True)
+    x = (mean + contrast * (x - mean)).clamp(0, 1)
+    gray = gray_scale(x)
+    x = (gray + color * (x - gray)).clamp(0, 1)
+    # PIL's SMOOTH filter, image borders are left untouched
+    kernel = x.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]).div(13).expand(3, 1, 3, 3)
+    blur = x.clone()
+    blur[:, :, 1:-1, 1:-1] = F.conv2d(x, kernel, groups=3)
+    x = (blur + sharp * (x - blur)).clamp(0, 1)
+
+    return x
+
+
+class BatchAugment(object):
+    """Flip, crop, rotation, color enhancement and pepper noise of a collated uint8 batch on its device.
+
+    Draws from the same distributions as randomAffine / colorEnhance / randomPeper and is seedable.
+    """
+    def __init__(self, trainsize, seed=None):
+        self.trainsize = trainsize
+        self.rng = np.random.default_rng(seed)
+
+    def sample_theta(self, sizes, out_h, out_w):
+        out_to_pixel = np.array([[out_w / 2.0, 0, out_w / 2.0], [0, out_h / 2.0, out_h / 2.0], [0, 0, 1]])
+        theta = []
+        for w, h in sizes.tolist():
+            matrix = affine_matrix(w, h, random_affine_params(w, h, rng=self.rng), (out_w, out_h))
+            pixel_to_src = np.array([[2.0 / w, 0, -1], [0, 2.0 / h, -1], [0, 0, 1]])
+            theta.append((pixel_to_src @ matrix @ out_to_pixel)[:2])
+        return torch.tensor(np.stack(theta), dtype=torch.float32)
+
+    def __call__(self, pack):
+        images = pack['image']
+        B, device = images.shape[0], images.device
+        # The workers resized to trainsize, or to the (H, W) bucket of this batch
+        H, W = images.shape[-2:]
+        theta = self.sample_theta(pack.pop('size'), H, W).to(device)
+        grid = F.affine_grid(theta, [B, 1, H, W], align_corners=False)
+
+        images = F.grid_sample(images.float().div_(255), grid, mode='bilinear', align_corners=False)
+        factors = [self.rng.integers(5, 16, B) / 10.0, self.rng.integers(5, 16, B) / 10.0,
+                   self.rng.integers(0, 21, B) / 10.0, self.rng.integers(0, 31, B) / 10.0]
+        factors = [torch.tensor(f, dtype=torch.float32, device=device).view(B, 1, 1, 1) for f in factors]
+        images = batch_color_enhance(images, *factors)
+        mean, std = images.new_tensor(IMAGE_MEAN).view(1, 3, 1, 1), images.new_tensor(IMAGE_STD).view(1, 3, 1, 1)
+        pack['image'] = (images - mean) / std
+
+        for keys, mode in [(LABELS_NEAREST, 'nearest'), (LABELS_BILINEAR, 'bilinear')]:
+            for key in keys:
+                if key in pack:
+                    pack[key] = F.grid_sample(pack[key].float().div_(255), grid, mode=mode, align_corners=False)
+
+        # Pepper noise on the gt, int(0.0015*H*W) positions per sample
+        gt = pack['gt'].view(B, -1)
+        noise_num = int(0.0015 * gt.shape[1])
+        positions = torch.from_numpy(self.rng.integers(0, gt.shape[1], (B, noise_num))).to(device)
+        values = torch.from_numpy(self.rng.integers(0, 2, (B, noise_num))).to(device=device, dtype=gt.dtype)
+        gt.scatter_(1, positions, values)
+
+        return pack
+
+
+class ScaleLabels(object):
+    """Device side of the uint8 input pipeline: labels to [0, 1] floats, the image stays uint8 for the backbone."""
+    def __call__(self, pack):
+        for key in LABELS_NEAREST + LABELS_BILINEAR:
+            if key in pack:
+                pack[key] = pack[key].float().div_(255)
+        return pack
+
+
+class DeviceAugmentLoader(object):
+    """Wraps a DataLoader of uint8 samples and runs BatchAugment after moving each batch to the device.
+
+    The training engine's DevicePrefetcher unwraps it and runs both on its side stream, iterating it directly
+    copies and augments on the current stream.
+    """
+    def __init__(self, loader, augment, device):
+        self.loader = loader
+        self.augment = augment
+        self.device = device
+        self.dataset = loader.dataset
+
+    def __iter__(self):
+        for pack in self.loader:
+            pack = {k: v.to(self.device, non_blocking=True) if k not in ['index', 'size'] else v
+                    for k, v in pack.items()}
+            yield self.augment(pack)
+
+    def __len__(self):
+        return len(self.loader)
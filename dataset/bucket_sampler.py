@@ -0,0 +1,70 @@
+import numpy as np
+import torch.utils.data as data
+
+
+def make_buckets(base_size=384, multiple=32, max_ratio=2.0):
+    """(H, W) buckets, multiples of `multiple`, whose pixel count stays close to base_size**2."""
+    area = base_size * base_size
+    buckets = set()
+    for w in range(multiple, int(base_size * np.sqrt(max_ratio)) + multiple, multiple):
+        h = int(round(area / w / multiple)) * multiple
+        if h > 0 and 1.0 / max_ratio <= w / h <= max_ratio:
+            buckets.add((h, w))
+    return sorted(buckets, key=lambda hw: hw[1] / hw[0])
+
+
+def split_key(key, size):
+    # Bucketed batch samplers pass (index, (H, W)) keys, returns the index and the PIL output (w, h)
+    if isinstance(key, (tuple, list)):
+        index, (h, w) = key
+        return int(index), (int(w), int(h))
+    return key, (size, size)
+
+
+class AspectRatioBatchSampler(data.Sampler):
+    """Batches of samples sharing the (H, W) bucket closest to their aspect ratio.
+
+    Yields lists of (index, (H, W)) dataset keys, so a batch never needs padding.
+
+    Args:
+        sizes (list[tuple]): source (w, h) of every sample
+        batch_size (int): samples per batch
+        buckets (list[tuple]): (H, W) candidates, see make_buckets
+        shuffle (bool): reshuffle the samples of every bucket and the batch order at every epoch
+        drop_last (bool): drop the incomplete batch of every bucket
+        seed (int): base seed of the per-epoch shuffling
+    """
+    def __init__(self, sizes, batch_size, buckets, shuffle=True, drop_last=False, seed=0):
+        self.batch_size = batch_size
+        self.buckets = [tuple(b) for b in buckets]
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        ratios = np.log([w / h for w, h in sizes])
+        bucket_ratios = np.log([w / h for h, w in self.buckets])
+        assignment = np.abs(ratios[:, None] - bucket_ratios[None, :]).argmin(1)
+        self.bucket_indices = [np.flatnonzero(assignment == b) for b in range(len(self.buckets))]
+        counts = [len(indices) for indices in self.bucket_indices]
+        print('[INFO]: Aspect ratio buckets {}'.format(
+            ', '.join('{}x{}: {}'.format(h, w, n) for (h, w), n in zip(self.buckets, counts) if n > 0)))
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        batches = []
+        for bucket, indices in zip(self.buckets, self.bucket_indices):
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append([(int(i), bucket) for i in batch])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.bucket_indices)
+        return sum(-(-len(indices) // self.batch_size) for indices in self.bucket_indices)
@@ -6,59 +6,54 @@ import random
 import numpy as np
 from PIL import Image
 from PIL import ImageEnhance
-from dataset.augment import cv_random_flip_rgb, randomCrop_rgb, randomRotation_rgb
-from dataset.augment import cv_random_flip_rgbd, randomCrop_rgbd, randomRotation_rgbd
-from dataset.augment import cv_random_flip_weak, randomCrop_weak, randomRotation_weak, colorEnhance, randomGaussian, randomPeper
+from dataset.augment import randomAffine, colorEnhance, randomGaussian, randomPeper
+from dataset.manifest import build_manifest
+from dataset.batch_augment import to_uint8_sample
+from dataset.bucket_sampler import split_key
+
+
+def draft_rgb_loader(path, min_size=None):
+    """Decode an RGB image, JPEGs are DCT-downscaled by libjpeg (1/2, 1/4, 1/8) while both sides stay >= min_size."""
+    with open(path, 'rb') as f:
+        img = Image.open(f)
+        if min_size is not None:
+            img.draft('RGB', (min_size, min_size))
+        return img.convert('RGB')
 
 
 class SalObjDatasetRGB(data.Dataset):
-    def __init__(self, image_root, gt_root, trainsize):
+    def __init__(self, image_root, gt_root, trainsize, device_augment=False, uint8_input=False):
         self.trainsize = trainsize
-        self.images = [image_root + f for f in os.listdir(image_root) if f.endswith('.jpg')]
-        self.gts = [gt_root + f for f in os.listdir(gt_root) if f.endswith('.jpg')
-                    or f.endswith('.png')]
-        self.images = sorted(self.images)
-        self.gts = sorted(self.gts)
-        self.filter_files()
+        self.device_augment = device_augment
+        manifest = build_manifest({'image': image_root, 'gt': gt_root},
+                                  exts={'image': ('.jpg',), 'gt': ('.jpg', '.png')}, size_check=['gt'])
+        self.images, self.gts, self.sizes = manifest['image'], manifest['gt'], manifest['sizes']
         self.size = len(self.images)
         self.img_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
-        self.gt_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
-            transforms.ToTensor()])
-
-    def __getitem__(self, index):
-        image = self.rgb_loader(self.images[index])
+        self.gt_transform = transforms.ToTensor()
+        if uint8_input:
+            # Raw uint8 CHW planes, labels are scaled on the device and the backbone folds Normalize in
+            self.img_transform = self.gt_transform = transforms.PILToTensor()
+
+    def __getitem__(self, key):
+        # key is an index, or (index, (H, W)) from the aspect ratio bucketing sampler
+        index, out_size = split_key(key, self.trainsize)
+        image = self.rgb_loader(self.images[index], max(out_size))
         gt = self.binary_loader(self.gts[index])
-        image, gt = cv_random_flip_rgb(image, gt)
-        image, gt = randomCrop_rgb(image, gt)
-        image, gt = randomRotation_rgb(image, gt)
+        if self.device_augment:
+            return to_uint8_sample({'image': image, 'gt': gt}, out_size, index)
+        image, gt = randomAffine([image, gt], [Image.BILINEAR, Image.NEAREST], out_size)
         image = colorEnhance(image)
         gt = randomPeper(gt)
         image = self.img_transform(image)
         gt = self.gt_transform(gt)
         return {'image': image, 'gt': gt, 'index': index}
 
-    def filter_files(self):
-        assert len(self.images) == len(self.gts)
-        images = []
-        gts = []
-        for img_path, gt_path in zip(self.images, self.gts):
-            img = Image.open(img_path)
-            gt = Image.open(gt_path)
-            if img.size == gt.size:
-                images.append(img_path)
-                gts.append(gt_path)
-        self.images = images
-        self.gts = gts
-
-    def rgb_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
+    def rgb_loader(self, path, min_size=None):
+        return draft_rgb_loader(path, min_size or self.trainsize)
 
     def binary_loader(self, path):
         with open(path, 'rb') as f:
@@ -81,36 +76,35 @@ class SalObjDatasetRGB(data.Dataset):
 
 
 class SalObjDatasetRGBD(data.Dataset):
-    def __init__(self, image_root, gt_root, depth_root=None, trainsize=352):
+    def __init__(self, image_root, gt_root, depth_root=None, trainsize=352, device_augment=False, uint8_input=False):
         self.trainsize = trainsize
-        self.images = [image_root + f for f in os.listdir(image_root) if f.endswith('.jpg')]
-        self.gts = [gt_root + f for f in os.listdir(gt_root) if f.endswith('.jpg')
-                    or f.endswith('.png')]
-        self.depths = [depth_root + f for f in os.listdir(depth_root) if f.endswith('.bmp')
-                       or f.endswith('.png')]
-        self.images = sorted(self.images)
-        self.gts = sorted(self.gts)
-        self.depths = sorted(self.depths)
-        self.filter_files()
+        self.device_augment = device_augment
+        manifest = build_manifest({'image': image_root, 'gt': gt_root, 'depth': depth_root},
+                                  exts={'image': ('.jpg',), 'gt': ('.jpg', '.png'), 'depth': ('.bmp', '.png')},
+                                  size_check=['gt', 'depth'])
+        self.images, self.gts, self.depths = manifest['image'], manifest['gt'], manifest['depth']
+        self.sizes = manifest['sizes']
         self.size = len(self.images)
         self.img_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
             ])
-        self.gt_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
-            transforms.ToTensor()])
-        self.depths_transform = transforms.Compose(
-            [transforms.Resize((self.trainsize, self.trainsize)), transforms.ToTensor()])
-
-    def __getitem__(self, index):
-        image = self.rgb_loader(self.images[index])
+        self.gt_transform = transforms.ToTensor()
+        self.depths_transform = transforms.ToTensor()
+        if uint8_input:
+            # Raw uint8 CHW planes, labels are scaled on the device and the backbone folds Normalize in
+            self.img_transform = self.gt_transform = self.depths_transform = transforms.PILToTensor()
+
+    def __getitem__(self, key):
+        # key is an index, or (index, (H, W)) from the aspect ratio bucketing sampler
+        index, out_size = split_key(key, self.trainsize)
+        image = self.rgb_loader(self.images[index], max(out_size))
         gt = self.binary_loader(self.gts[index])
         depth = self.binary_loader(self.depths[index])
-        image, gt, depth = cv_random_flip_rgbd(image, gt, depth)
-        image, gt, depth = randomCrop_rgbd(image, gt, depth)
-        image, gt, depth = randomRotation_rgbd(image, gt, depth)
+        if self.device_augment:
+            return to_uint8_sample({'image': image, 'gt': gt, 'depth': depth}, out_size, index)
+        image, gt, depth = randomAffine([image, gt, depth], [Image.BILINEAR, Image.NEAREST, Image.BILINEAR],
+                                        out_size)
         image = colorEnhance(image)
         gt = randomPeper(gt)
         image = self.img_transform(image)
@@ -119,27 +113,8 @@ class SalObjDatasetRGBD(data.Dataset):
 
         return {'image': image, 'gt': gt, 'depth': depth, 'index': index}
 
-    def filter_files(self):
-        assert len(self.images) == len(self.gts) and len(self.gts) == len(self.images)
-        images = []
-        gts = []
-        depths = []
-        for img_path, gt_path, depth_path in zip(self.images, self.gts, self.depths):
-            img = Image.open(img_path)
-            gt = Image.open(gt_path)
-            depth = Image.open(depth_path)
-            if img.size == gt.size and gt.size == depth.size:
-                images.append(img_path)
-                gts.append(gt_path)
-                depths.append(depth_path)
-        self.images = images
-        self.gts = gts
-        self.depths = depths
-
-    def rgb_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
+    def rgb_loader(self, path, min_size=None):
+        return draft_rgb_loader(path, min_size or self.trainsize)
 
     def binary_loader(self, path):
         with open(path, 'rb') as f:
@@ -161,41 +136,39 @@ class SalObjDatasetRGBD(data.Dataset):
 
 
 class SalObjDatasetWeak(data.Dataset):
-    def __init__(self, image_root, gt_root, mask_root, gray_root, trainsize):
+    def __init__(self, image_root, gt_root, mask_root, gray_root, trainsize, device_augment=False, uint8_input=False):
         self.trainsize = trainsize
-        self.images = [image_root + f for f in os.listdir(image_root) if f.endswith('.jpg')]
-        self.gts = [gt_root + f for f in os.listdir(gt_root) if f.endswith('.jpg')
-                    or f.endswith('.png')]
-        self.masks = [mask_root + f for f in os.listdir(mask_root) if f.endswith('.png')]
-        self.grays = [gray_root + f for f in os.listdir(gray_root) if f.endswith('.png')]
-        self.images = sorted(self.images)
-        self.gts = sorted(self.gts)
-        self.masks = sorted(self.masks)
-        self.grays = sorted(self.grays)
-        self.filter_files()
+        self.device_augment = device_augment
+        manifest = build_manifest({'image': image_root, 'gt': gt_root, 'mask': mask_root, 'gray': gray_root},
+                                  exts={'image': ('.jpg',), 'gt': ('.jpg', '.png'), 'mask': ('.png',), 'gray': ('.png',)},
+                                  size_check=['gt'])
+        self.images, self.gts = manifest['image'], manifest['gt']
+        self.masks, self.grays = manifest['mask'], manifest['gray']
+        self.sizes = manifest['sizes']
         self.size = len(self.images)
         self.img_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
-        self.gt_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
-            transforms.ToTensor()])
-        self.mask_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
-            transforms.ToTensor()])
-        self.gray_transform = transforms.Compose([
-            transforms.Resize((self.trainsize, self.trainsize)),
-            transforms.ToTensor()])
-
-    def __getitem__(self, index):
-        image = self.rgb_loader(self.images[index])
+        self.gt_transform = transforms.ToTensor()
+        self.mask_transform = transforms.ToTensor()
+        self.gray_transform = transforms.ToTensor()
+        if uint8_input:
+            # Raw uint8 CHW planes, labels are scaled on the device and the backbone folds Normalize in
+            self.img_transform = self.gt_transform = transforms.PILToTensor()
+            self.mask_transform = self.gray_transform = transforms.PILToTensor()
+
+    def __getitem__(self, key):
+        # key is an index, or (index, (H, W)) from the aspect ratio bucketing sampler
+        index, out_size = split_key(key, self.trainsize)
+        image = self.rgb_loader(self.images[index], max(out_size))
         gt = self.binary_loader(self.gts[index])
         mask = self.binary_loader(self.masks[index])
         gray = self.binary_loader(self.grays[index])
-        image, gt, mask, gray = cv_random_flip_weak(image, gt, mask, gray)
-        image, gt, mask, gray = randomCrop_weak(image, gt, mask, gray)
-        image, gt, mask, gray = randomRotation_weak(image, gt, mask, gray)
+        if self.device_augment:
+            return to_uint8_sample({'image': image, 'gt': gt, 'mask': mask, 'gray': gray}, out_size, index)
+        image, gt, mask, gray = randomAffine([image, gt, mask, gray],
+                                             [Image.BILINEAR, Image.NEAREST, Image.NEAREST, Image.BILINEAR],
+                                             out_size)
         image = colorEnhance(image)
         # gt=randomGaussian(gt)
         gt = randomPeper(gt)
@@ -206,25 +179,8 @@ class SalObjDatasetWeak(data.Dataset):
 
         return {'image': image, 'gt': gt, 'mask': mask, 'gray': gray, 'index': index}
 
-    def filter_files(self):
-        assert len(self.images) == len(self.gts)
-        images, gts, masks, grays = [], [], [], []
-        for img_path, gt_path, mask_path, gray_path in zip(self.images, self.gts, self.masks, self.grays):
-            img, gt, mask, gray = Image.open(img_path), Image.open(gt_path), Image.open(mask_path), Image.open(gray_path)
-            if img.size == gt.size:
-                images.append(img_path)
-                gts.append(gt_path)
-                masks.append(mask_path)
-                grays.append(gray_path)
-        self.images = images
-        self.gts = gts
-        self.masks = masks
-        self.grays = grays
-
-    def rgb_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
+    def rgb_loader(self, path, min_size=None):
+        return draft_rgb_loader(path, min_size or self.trainsize)
 
     def binary_loader(self, path):
         with open(path, 'rb') as f:
@@ -250,91 +206,76 @@ class SalObjDatasetWeak(data.Dataset):
         return self.size
 
 
-class test_dataset:
+class test_dataset(data.Dataset):
     def __init__(self, image_root, testsize):
         self.testsize = testsize
-        self.images = [os.path.join(image_root, f) for f in os.listdir(image_root) if f.endswith('.jpg') or f.endswith('.png')]
-        self.images = sorted(self.images)
+        manifest = build_manifest({'image': image_root}, exts={'image': ('.jpg', '.png')})
+        self.images, self.sizes = manifest['image'], manifest['sizes']
         self.transform = transforms.Compose([
-            transforms.Resize((self.testsize, self.testsize)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
         self.size = len(self.images)
         self.index = 0
 
+    def __getitem__(self, key):
+        # key is an index, or (index, (H, W)) from the aspect ratio bucketing sampler
+        index, out_size = split_key(key, self.testsize)
+        image = self.rgb_loader(self.images[index], max(out_size)).resize(out_size, Image.BILINEAR)
+        image = self.transform(image)
+        # original (H, W) from the manifest, the decoded image may be draft-reduced
+        w, h = self.sizes[index]
+        return {'image': image, 'size': torch.tensor([h, w]), 'name': self.get_name(index)}
+
     def load_data(self):
-        image = self.rgb_loader(self.images[self.index])
-        HH = image.size[0]
-        WW = image.size[1]
-        image = self.transform(image).unsqueeze(0)
-        name = self.images[self.index].split('/')[-1]
+        sample = self[self.index]
+        HH, WW = self.sizes[self.index]
+        self.index += 1
+        return sample['image'].unsqueeze(0), None, HH, WW, sample['name']
+
+    def get_name(self, index):
+        name = self.images[index].split('/')[-1]
         if name.endswith('.jpg'):
             name = name.split('.jpg')[0] + '.png'
-        self.index += 1
-        return image, None, HH, WW, name
+        return name
 
-    def rgb_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
+    def rgb_loader(self, path, min_size=None):
+        return draft_rgb_loader(path, min_size or self.testsize)
 
     def binary_loader(self, path):
         with open(path, 'rb') as f:
             img = Image.open(f)
             return img.convert('L')
 
+    def __len__(self):
+        return self.size
+
 
-class test_dataset_rgbd:
+class test_dataset_rgbd(test_dataset):
     def __init__(self, image_root, testsize):
         depth_root = image_root[:-3] + 'depth'
         self.testsize = testsize
-        self.images = [os.path.join(image_root, f) for f in os.listdir(image_root) if f.endswith('.jpg')
-                       or f.endswith('.png')]
-        self.depths = [os.path.join(depth_root, f) for f in os.listdir(depth_root) if f.endswith('.bmp')
-                       or f.endswith('.png')]
-        self.images = sorted(self.images)
-        self.depths = sorted(self.depths)
+        manifest = build_manifest({'image': image_root, 'depth': depth_root},
+                                  exts={'image': ('.jpg', '.png'), 'depth': ('.bmp', '.png')})
+        self.images, self.depths, self.sizes = manifest['image'], manifest['depth'], manifest['sizes']
         self.transform = transforms.Compose([
-            transforms.Resize((self.testsize, self.testsize)),
             transforms.ToTensor(),
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
-        # self.gt_transform = transforms.Compose([
-        #     transforms.Resize((self.trainsize, self.trainsize)),
-        #     transforms.ToTensor()])
-        self.depths_transform = transforms.Compose(
-            [transforms.Resize((self.testsize, self.testsize)), transforms.ToTensor()])
+        self.depths_transform = transforms.ToTensor()
         self.size = len(self.images)
         self.index = 0
 
-    def load_data(self):
-        image = self.rgb_loader(self.images[self.index])
-        HH = image.size[0]
-        WW = image.size[1]
-        image = self.transform(image).unsqueeze(0)
-        depth = self.binary_loader(self.depths[self.index])
-        depth = self.depths_transform(depth).unsqueeze(0)
-
-        name = self.images[self.index].split('/')[-1]
-        # image_for_post=self.rgb_loader(self.images[self.index])
-        # image_for_post=image_for_post.resize(gt.size)
-        if name.endswith('.jpg'):
-            name = name.split('.jpg')[0] + '.png'
-        self.index += 1
-        self.index = self.index % self.size
-        return image, depth, HH, WW, name
-
-    def rgb_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('RGB')
-
-    def binary_loader(self, path):
-        with open(path, 'rb') as f:
-            img = Image.open(f)
-            return img.convert('L')
+    def __getitem__(self, key):
+        sample = super(test_dataset_rgbd, self).__getitem__(key)
+        index, out_size = split_key(key, self.testsize)
+        depth = self.binary_loader(self.depths[index]).resize(out_size, Image.BILINEAR)
+        sample['depth'] = self.depths_transform(depth)
+        return sample
 
-    def __len__(self):
-        return self.size
+    def load_data(self):
+        sample = self[self.index]
+        HH, WW = self.sizes[self.index]
+        self.index = (self.index + 1) % self.size
+        return sample['image'].unsqueeze(0), sample['depth'].unsqueeze(0), HH, WW, sample['name']
 
 
 # class eval_Dataset(data.Dataset):
@@ -365,24 +306,8 @@ class test_dataset_rgbd:
 
 class eval_Dataset(data.Dataset):
     def __init__(self, img_root, label_root):
-        lst_label = sorted(os.listdir(label_root))
-        # print(label_root)
-        lst_pred = sorted(os.listdir(img_root))
-        # print(img_root)
-        self.label_abbr, self.pred_abbr = lst_label[0].split('.')[-1], lst_pred[0].split('.')[-1]
-        label_list, pred_list = [], []
-        for name in lst_label:
-            label_name = name.split('.')[0]
-            if label_name+'.'+self.label_abbr in lst_label:
-                label_list.append(name)
-    
-        for name in lst_pred:
-            label_name = name.split('.')[0]
-            if label_name+'.'+self.pred_abbr in lst_pred:
-                pred_list.append(name)
-
-        self.image_path = list(map(lambda x: os.path.join(img_root, x), pred_list))
-        self.label_path = list(map(lambda x: os.path.join(label_root, x), label_list))
+        manifest = build_manifest({'pred': img_root, 'gt': label_root})
+        self.image_path, self.label_path = manifest['pred'], manifest['gt']
         self.trans = transforms.Compose([transforms.ToTensor()])
 
     def get_img_pil(self, path):
@@ -1,20 +1,97 @@
+import torch
 import torch.utils.data as data
-from dataset.dataloader import SalObjDatasetRGBD, SalObjDatasetWeak, SalObjDatasetRGB
+from dataset.dataloader import SalObjDatasetRGBD, SalObjDatasetWeak, SalObjDatasetRGB, test_dataset, test_dataset_rgbd
+from dataset.packed import SalObjDatasetPacked, has_packed_cache, get_packed_root
+from dataset.shards import SalObjDatasetShards
+from dataset.augment import seed_worker
+from dataset.loader_tuner import autotune_loader
+from dataset.batch_augment import BatchAugment, DeviceAugmentLoader, ScaleLabels
+from dataset.bucket_sampler import AspectRatioBatchSampler, make_buckets
 
 
-def get_loader(option, pin_memory=True):
-    if option['task'] == 'RGBD-SOD':
-        dataset = SalObjDatasetRGBD(option['paths']['image_root'], option['paths']['gt_root'], 
-                                    option['paths']['depth_root'], trainsize=option['trainsize'])
+def build_dataset(option, use_packed=True):
+    device_augment = option.get('device_augment', False)
+    uint8_input = option.get('uint8_input', False)
+    if use_packed and option.get('shard_root'):
+        print('[INFO]: Stream training set from shards in {}'.format(option['shard_root']))
+        dataset = SalObjDatasetShards(option['shard_root'], trainsize=option['trainsize'], seed=option['seed'],
+                                      device_augment=device_augment, uint8_input=uint8_input)
+    elif use_packed and has_packed_cache(option['paths'], option['task']):
+        pack_root = get_packed_root(option['paths']['image_root'])
+        print('[INFO]: Load packed training set from {}'.format(pack_root))
+        dataset = SalObjDatasetPacked(pack_root, trainsize=option['trainsize'], device_augment=device_augment,
+                                      uint8_input=uint8_input)
+    elif option['task'] == 'RGBD-SOD':
+        dataset = SalObjDatasetRGBD(option['paths']['image_root'], option['paths']['gt_root'],
+                                    option['paths']['depth_root'], trainsize=option['trainsize'],
+                                    device_augment=device_augment, uint8_input=uint8_input)
     elif option['task'] == 'Weak-RGB-SOD':
-        dataset = SalObjDatasetWeak(option['paths']['image_root'], option['paths']['gt_root'], 
-                                    option['paths']['mask_root'], option['paths']['gray_root'], 
-                                    trainsize=option['trainsize'])
+        dataset = SalObjDatasetWeak(option['paths']['image_root'], option['paths']['gt_root'],
+                                    option['paths']['mask_root'], option['paths']['gray_root'],
+                                    trainsize=option['trainsize'], device_augment=device_augment,
+                                    uint8_input=uint8_input)
     else:
-        dataset = SalObjDatasetRGB(option['paths']['image_root'], option['paths']['gt_root'], trainsize=option['trainsize'])
+        dataset = SalObjDatasetRGB(option['paths']['image_root'], option['paths']['gt_root'],
+                                   trainsize=option['trainsize'], device_augment=device_augment,
+                                   uint8_input=uint8_input)
+
+    return dataset
+
+
+def get_bucket_sampler(option, dataset, batch_size, shuffle, drop_last):
+    """Aspect ratio bucketing, None when disabled or unsupported by the dataset."""
+    if not option.get('aspect_buckets', False):
+        return None
+    if isinstance(dataset, data.IterableDataset):
+        print('[INFO]: Aspect ratio buckets are not supported by streamed shards, use square batches')
+        return None
+    if option['decoder'] == 'trans' or option['uncer_method'] == 'vae':
+        raise ValueError('Aspect ratio buckets need a resolution-agnostic model, '
+                         'the trans decoder and the vae encoder are built for square trainsize inputs')
+    buckets = make_buckets(option['trainsize'])
+    return AspectRatioBatchSampler(dataset.sizes, batch_size, buckets, shuffle=shuffle, drop_last=drop_last,
+                                   seed=option['seed'])
+
+
+def get_loader(option, pin_memory=True):
+    dataset = build_dataset(option)
+    setting = {'num_workers': option['batch_size'], 'prefetch_factor': 2, 'pin_memory': pin_memory}
+    if option.get('loader_autotune', False):
+        setting = autotune_loader(dataset, option)
+    if isinstance(dataset, SalObjDatasetShards):
+        dataset.num_workers = setting['num_workers']   # the per-rank length depends on the loader splits
+    batch_sampler = get_bucket_sampler(option, dataset, option['batch_size'], shuffle=True, drop_last=True)
+    if batch_sampler is not None:
+        batching = {'batch_sampler': batch_sampler}
+    else:
+        batching = {'batch_size': option['batch_size'],
+                    'shuffle': not isinstance(dataset, data.IterableDataset)}   # shards shuffle themselves
     data_loader = data.DataLoader(dataset=dataset,
-                                  batch_size=option['batch_size'],
-                                  shuffle=True,
-                                  num_workers=option['batch_size'],
-                                  pin_memory=pin_memory)
+                                  persistent_workers=True,   # no worker re-spawn at every epoch
+                                  worker_init_fn=seed_worker,
+                                  **batching, **setting)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if option.get('device_augment', False):
+        # Workers only decode, augmentation runs batched on the training device
+        data_loader = DeviceAugmentLoader(data_loader, BatchAugment(option['trainsize'], seed=option['seed']), device)
+    elif option.get('uint8_input', False):
+        data_loader = DeviceAugmentLoader(data_loader, ScaleLabels(), device)
     return data_loader, dataset.size
+
+
+def get_test_loader(option, image_root, pin_memory=True):
+    if option['task'] == 'RGBD-SOD':
+        dataset = test_dataset_rgbd(image_root, option['testsize'])
+    else:
+        dataset = test_dataset(image_root, option['testsize'])
+    # Fixed testsize (or one bucket per batch), so samples batch directly, workers decode ahead of the model
+    batch_sampler = get_bucket_sampler(option, dataset, option['test_batch_size'], shuffle=False, drop_last=False)
+    if batch_sampler is not None:
+        batching = {'batch_sampler': batch_sampler}
+    else:
+        batching = {'batch_size': option['test_batch_size'], 'shuffle': False}
+    data_loader = data.DataLoader(dataset=dataset,
+                                  num_workers=option['test_batch_size'],
+                                  pin_memory=pin_memory,
+                                  **batching)
+    return data_loader
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import socket
+import torch
+import torch.utils.data as data
+from dataset.augment import seed_worker
+
+
+TUNE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'transformer_sod', 'loader_tune.json')
+WORKER_CANDIDATES = [2, 4, 6, 8, 12, 16, 24, 32]
+PREFETCH_CANDIDATES = [2, 4, 8]
+
+
+def get_tune_key(option):
+    # everything that changes the per-sample worker cost: data source, output size and what runs in the workers
+    shard_root = option.get('shard_root')
+    return '{}|{}|{}|{}|bs{}|size{}|device_augment{}|uint8{}'.format(
+        socket.gethostname(), option['task'], os.path.abspath(option['paths']['image_root']),
+        os.path.abspath(shard_root) if shard_root else None, option['batch_size'], option['trainsize'],
+        int(option.get('device_augment', False)), int(option.get('uint8_input', False)))
+
+
+def load_tune_cache():
+    try:
+        with open(TUNE_CACHE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_tune_cache(cache):
+    os.makedirs(os.path.dirname(TUNE_CACHE), exist_ok=True)
+    with open(TUNE_CACHE + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(TUNE_CACHE + '.tmp', TUNE_CACHE)
+
+
+def probe_loader(dataset, batch_size, setting, num_batches=20, warmup_batches=3):
+    """Samples/sec of one DataLoader setting, worker start-up and the first batches are not timed."""
+    shuffle = not isinstance(dataset, data.IterableDataset)
+    loader = data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, drop_last=True,
+                             worker_init_fn=seed_worker, **setting)
+    iterator = iter(loader)
+    num_batches = min(num_batches, len(loader) - warmup_batches)
+    for _ in range(warmup_batches):
+        next(iterator)
+    start = time.time()
+    for _ in range(num_batches):
+        next(iterator)
+    samples_per_sec = num_batches * batch_size / (time.time() - start)
+    del iterator, loader
+
+    return samples_per_sec
+
+
+def autotune_loader(dataset, option, num_batches=20):
+    """Pick num_workers, then prefetch_factor, then pin_memory by timing the real dataset.
+
+    One dimension is swept at a time with the others at their best value so far. The result is
+    cached per (host, task, dataset / shards, batch size, trainsize, device_augment, uint8_input),
+    delete TUNE_CACHE to re-tune.
+    """
+    key = get_tune_key(option)
+    cache = load_tune_cache()
+    if key in cache:
+        print('[INFO]: Loader setting from {}: {}'.format(TUNE_CACHE, cache[key]))
+        return cache[key]['setting']
+    if len(dataset) // option['batch_size'] < 4:
+        print('[INFO]: Dataset too small to tune the loader')
+        return {'num_workers': option['batch_size'], 'prefetch_factor': 2, 'pin_memory': torch.cuda.is_available()}
+
+    cpu_count = os.cpu_count() or 1
+    workers = [w for w in WORKER_CANDIDATES if w <= cpu_count] or [cpu_count]
+    best = {'num_workers': workers[0], 'prefetch_factor': 2, 'pin_memory': torch.cuda.is_available()}
+    results = {}
+    sweeps = [('num_workers', workers), ('prefetch_factor', PREFETCH_CANDIDATES)]
+    if torch.cuda.is_available():
+        sweeps.append(('pin_memory', [True, False]))
+    for name, values in sweeps:
+        for value in values:
+            setting = dict(best, **{name: value})
+            tag = 'workers={num_workers} prefetch={prefetch_factor} pin={pin_memory}'.format(**setting)
+            if tag not in results:
+                results[tag] = (probe_loader(dataset, option['batch_size'], setting, num_batches), setting)
+                print('[INFO]: Loader probe {}: {:.1f} samples/sec'.format(tag, results[tag][0]))
+        best = max(results.values(), key=lambda x: x[0])[1]
+
+    samples_per_sec = max(r[0] for r in results.values())
+    print('[INFO]: Best loader setting {} with {:.1f} samples/sec'.format(best, samples_per_sec))
+    cache[key] = {'setting': best, 'samples_per_sec': samples_per_sec}
+    save_tune_cache(cache)
+
+    return best
@@ -0,0 +1,102 @@
+import os
+import json
+import hashlib
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+
+IMAGE_EXTS = ('.jpg', '.png', '.bmp')
+MANIFEST_VERSION = 1
+
+
+def get_manifest_path(roots, exts):
+    key = json.dumps([[m, os.path.abspath(roots[m]), list(exts[m])] for m in roots])
+    name = '.manifest_{}.json'.format(hashlib.md5(key.encode()).hexdigest()[:12])
+    first_root = os.path.normpath(list(roots.values())[0])
+    return os.path.join(os.path.dirname(first_root), name)
+
+
+def load_cached_entries(path):
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['version'] == MANIFEST_VERSION:
+            return manifest['entries']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_manifest(path, manifest):
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # Dataset folders may be read-only, fall back to the user cache
+        cache_root = os.path.join(os.path.expanduser('~'), '.cache', 'transformer_sod')
+        os.makedirs(cache_root, exist_ok=True)
+        with open(os.path.join(cache_root, os.path.basename(path)), 'w') as f:
+            json.dump(manifest, f)
+
+
+def build_manifest(roots, exts=None, size_check=(), num_threads=16):
+    """Pair the files of several modality folders by file stem.
+
+    Args:
+        roots (dict): modality name -> folder, the first modality is the reference one
+        exts (dict | None): modality name -> accepted extensions. Default: IMAGE_EXTS
+        size_check (list): modalities whose (w, h) must equal the reference modality's size
+        num_threads (int): threads used to stat files and read image headers
+
+    Returns:
+        dict: modality name -> sorted list of paired paths, plus 'sizes' with the reference (w, h)
+    """
+    exts = exts or {m: IMAGE_EXTS for m in roots}
+    manifest_path = get_manifest_path(roots, exts)
+    cached = load_cached_entries(manifest_path)
+    if not cached:
+        fallback = os.path.join(os.path.expanduser('~'), '.cache', 'transformer_sod', os.path.basename(manifest_path))
+        cached = load_cached_entries(fallback)
+
+    files = {}
+    for modality, root in roots.items():
+        files[modality] = {}
+        for name in sorted(os.listdir(root)):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() in exts[modality] and stem not in files[modality]:
+                files[modality][stem] = os.path.join(root, name)
+    paths = [p for modality in roots for p in files[modality].values()]
+
+    def stat(path):
+        return os.stat(path).st_mtime
+
+    def read_size(path):
+        # Only the image header is parsed, pixels are not decoded
+        with Image.open(path) as img:
+            return img.size
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        mtimes = dict(zip(paths, pool.map(stat, paths)))
+        stale = [p for p in paths if p not in cached or cached[p][0] != mtimes[p]]
+        new_sizes = dict(zip(stale, pool.map(read_size, stale)))
+    entries = {p: [mtimes[p]] + list(new_sizes[p] if p in new_sizes else cached[p][1:]) for p in paths}
+    if stale or len(entries) != len(cached):
+        save_manifest(manifest_path, {'version': MANIFEST_VERSION, 'roots': roots, 'entries': entries})
+
+    modalities = list(roots.keys())
+    stems = sorted(set.intersection(*[set(files[m].keys()) for m in modalities]))
+    ref = modalities[0]
+    pairs = {m: [] for m in modalities}
+    pairs['sizes'] = []
+    for stem in stems:
+        ref_size = entries[files[ref][stem]][1:]
+        if all(entries[files[m][stem]][1:] == ref_size for m in size_check):
+            for m in modalities:
+                pairs[m].append(files[m][stem])
+            pairs['sizes'].append(tuple(ref_size))
+    if len(pairs[ref]) != len(files[ref]):
+        print('[INFO]: Manifest drops {} unpaired or size-mismatched samples in {}'.format(
+            len(files[ref]) - len(pairs[ref]), roots[ref]))
+
+    return pairs
@@ -0,0 +1,183 @@
+import os
+import json
+import shutil
+import numpy as np
+import torch.utils.data as data
+import torchvision.transforms as transforms
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from dataset.augment import randomAffine, colorEnhance, randomPeper, PLANE_RESAMPLE
+from dataset.batch_augment import to_uint8_sample
+from dataset.dataloader import draft_rgb_loader
+from dataset.bucket_sampler import split_key
+from dataset.manifest import IMAGE_EXTS
+
+
+# Packed layout (one directory next to image_root):
+#   meta.json        modalities, channels, sample names, task, file count / newest mtime of the source folders
+#   index.npy        int64 [num_samples, num_modalities, 3] -> (byte offset, height, width)
+#   <modality>.bin   raw uint8 HWC pixels of every sample, concatenated
+PACK_VERSION = 1
+MODALITY_CHANNELS = {'image': 3, 'gt': 1, 'depth': 1, 'mask': 1, 'gray': 1}
+TASK_MODALITIES = {'RGBD-SOD': ['image', 'gt', 'depth'],
+                   'Weak-RGB-SOD': ['image', 'gt', 'mask', 'gray']}
+
+
+def get_packed_root(image_root):
+    return os.path.join(os.path.dirname(os.path.normpath(image_root)), 'packed')
+
+
+def get_source_roots(paths, modalities):
+    return {m: paths[m + '_root'] for m in modalities}
+
+
+def source_fingerprint(source_roots):
+    # files added, removed or replaced under the source folders change the count or the newest mtime
+    fingerprint = {}
+    for modality, root in source_roots.items():
+        mtimes = [entry.stat().st_mtime for entry in os.scandir(root)
+                  if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS]
+        fingerprint[modality] = [len(mtimes), max(mtimes, default=0)]
+    return fingerprint
+
+
+def has_packed_cache(paths, task):
+    meta_path = os.path.join(get_packed_root(paths['image_root']), 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    modalities = TASK_MODALITIES.get(task, ['image', 'gt'])
+    if meta['version'] != PACK_VERSION or meta['modalities'] != modalities:
+        return False
+    if meta.get('source') != source_fingerprint(get_source_roots(paths, modalities)):
+        print('[WARNING]: The training files changed since {} was packed, load them from the folders. '
+              'Re-run `python -m dataset.packed` to refresh the pack'.format(os.path.dirname(meta_path)))
+        return False
+    return True
+
+
+def get_path_lists(dataset):
+    return {'image': dataset.images, 'gt': dataset.gts, 'depth': getattr(dataset, 'depths', None),
+            'mask': getattr(dataset, 'masks', None), 'gray': getattr(dataset, 'grays', None)}
+
+
+def pack_dataset(dataset, pack_root, modalities, task, source_roots, num_threads=8):
+    """Decode every (already filtered) sample of a training dataset once and store raw uint8 planes."""
+    source = source_fingerprint(source_roots)   # before decoding, a file changed meanwhile invalidates the pack
+    path_lists = get_path_lists(dataset)
+    num_samples = len(dataset.images)
+    index = np.zeros((num_samples, len(modalities), 3), dtype=np.int64)
+    tmp_root = pack_root.rstrip('/') + '.tmp'
+    os.makedirs(tmp_root, exist_ok=True)
+
+    def decode(args):
+        modality, path = args
+        # Full resolution, so that a pack does not depend on trainsize
+        loader = draft_rgb_loader if MODALITY_CHANNELS[modality] == 3 else dataset.binary_loader
+        return np.ascontiguousarray(np.asarray(loader(path), dtype=np.uint8))
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for m, modality in enumerate(modalities):
+            offset = 0
+            jobs = [(modality, path) for path in path_lists[modality]]
+            with open(os.path.join(tmp_root, modality + '.bin'), 'wb') as f:
+                for i, array in enumerate(pool.map(decode, jobs)):
+                    f.write(array.tobytes())
+                    index[i, m] = (offset, array.shape[0], array.shape[1])
+                    offset += array.size
+            print('[INFO]: Packed [{}] {} samples, {:.2f}GB'.format(modality, num_samples, offset / 1024**3))
+
+    np.save(os.path.join(tmp_root, 'index.npy'), index)
+    meta = {'version': PACK_VERSION, 'task': task, 'modalities': modalities,
+            'channels': [MODALITY_CHANNELS[m] for m in modalities],
+            'names': [os.path.basename(p) for p in dataset.images], 'source': source}
+    # meta.json is the completion marker, so it is written last
+    with open(os.path.join(tmp_root, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(pack_root):
+        shutil.rmtree(pack_root)
+    os.rename(tmp_root, pack_root)
+
+    return pack_root
+
+
+class PlaneAugment(object):
+    """Training augmentation of one sample given as decoded planes, shared by the packed and shard datasets."""
+    def __init__(self, modalities, trainsize, device_augment=False, uint8_input=False):
+        self.modalities = modalities
+        self.trainsize = trainsize
+        self.device_augment = device_augment
+        self.resamples = [PLANE_RESAMPLE[m] for m in modalities]
+        self.img_transform = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+        self.gt_transform = transforms.ToTensor()
+        if uint8_input:
+            # Raw uint8 CHW planes, labels are scaled on the device and the backbone folds Normalize in
+            self.img_transform = self.gt_transform = transforms.PILToTensor()
+
+    def __call__(self, planes, index, out_size=None):
+        out_size = out_size or self.trainsize
+        if self.device_augment:
+            return to_uint8_sample(dict(zip(self.modalities, planes)), out_size, index)
+        planes = randomAffine(planes, self.resamples, out_size)
+        sample = {}
+        for modality, plane in zip(self.modalities, planes):
+            if modality == 'image':
+                sample[modality] = self.img_transform(colorEnhance(plane))
+            elif modality == 'gt':
+                sample[modality] = self.gt_transform(randomPeper(plane))
+            else:
+                sample[modality] = self.gt_transform(plane)
+        sample['index'] = index
+
+        return sample
+
+
+class SalObjDatasetPacked(data.Dataset):
+    def __init__(self, pack_root, trainsize, device_augment=False, uint8_input=False):
+        self.pack_root = pack_root
+        self.trainsize = trainsize
+        with open(os.path.join(pack_root, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.modalities = self.meta['modalities']
+        self.channels = self.meta['channels']
+        self.index = np.load(os.path.join(pack_root, 'index.npy'), mmap_mode='r')
+        self.size = self.index.shape[0]
+        self.sizes = [(int(w), int(h)) for h, w in self.index[:, 0, 1:]]   # (w, h) of the image plane
+        self.memmaps = None   # opened lazily so that every DataLoader worker maps the files itself
+        self.augment = PlaneAugment(self.modalities, trainsize, device_augment, uint8_input)
+
+    def open_memmaps(self):
+        self.memmaps = [np.memmap(os.path.join(self.pack_root, m + '.bin'), dtype=np.uint8, mode='r')
+                        for m in self.modalities]
+
+    def plane_loader(self, index, m):
+        # Zero-copy view into the memmap, PIL only wraps the buffer
+        offset, h, w = (int(x) for x in self.index[index, m])
+        c = self.channels[m]
+        array = self.memmaps[m][offset:offset + h * w * c]
+        return Image.fromarray(array.reshape(h, w, c) if c == 3 else array.reshape(h, w))
+
+    def __getitem__(self, key):
+        index, out_size = split_key(key, self.trainsize)
+        if self.memmaps is None:
+            self.open_memmaps()
+        planes = [self.plane_loader(index, m) for m in range(len(self.modalities))]
+
+        return self.augment(planes, index, out_size)
+
+    def __len__(self):
+        return self.size
+
+
+if __name__ == '__main__':
+    # python -m dataset.packed --task SOD
+    from config import param as option
+    from dataset.get_loader import build_dataset
+    modalities = TASK_MODALITIES.get(option['task'], ['image', 'gt'])
+    pack_root = get_packed_root(option['paths']['image_root'])
+    print('[INFO]: Pack [{}] training set into {}'.format(option['task'], pack_root))
+    pack_dataset(build_dataset(option, use_packed=False), pack_root, modalities, option['task'],
+                 get_source_roots(option['paths'], modalities))
@@ -0,0 +1,181 @@
+import io
+import itertools
+import os
+import json
+import shutil
+import tarfile
+import numpy as np
+import torch.distributed as dist
+import torch.utils.data as data
+from PIL import Image
+from dataset.packed import PlaneAugment, TASK_MODALITIES, get_path_lists
+
+
+# Shard layout (one directory, default next to image_root):
+#   shards.json               modalities, task, shard names and sample counts
+#   shard-<n>.tar             members <index>.<modality><ext> holding the original encoded files,
+#                             the members of one sample are consecutive, samples in a seeded random order
+SHARD_VERSION = 1
+TARGET_SHARDS = 256   # well above num_workers x world_size, so that every loader split reads several shards
+
+
+def get_shard_root(image_root):
+    return os.path.join(os.path.dirname(os.path.normpath(image_root)), 'shards')
+
+
+def get_rank():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def get_samples_per_shard(num_samples, min_samples=16, max_samples=1000):
+    # about TARGET_SHARDS shards, not so small that the per-tar overhead dominates
+    return int(np.clip(num_samples // TARGET_SHARDS, min_samples, max_samples))
+
+
+def write_shards(dataset, shard_root, modalities, task, samples_per_shard=None, seed=0):
+    """Copy the encoded files of every (already filtered) sample into sequential tar shards.
+
+    The samples are permuted before writing, so that a shard, and a batch read from it, mixes the whole set.
+    """
+    path_lists = get_path_lists(dataset)
+    num_samples = len(dataset.images)
+    samples_per_shard = samples_per_shard or get_samples_per_shard(num_samples)
+    num_shards = -(-num_samples // samples_per_shard)
+    order = np.random.default_rng(seed).permutation(num_samples)
+    tmp_root = shard_root.rstrip('/') + '.tmp'
+    os.makedirs(tmp_root, exist_ok=True)
+
+    shards = []
+    for indices in np.array_split(order, num_shards):   # sizes differ by at most one
+        name = 'shard-{:05d}.tar'.format(len(shards))
+        with tarfile.open(os.path.join(tmp_root, name), 'w') as tar:
+            for index in indices.tolist():
+                for modality in modalities:
+                    path = path_lists[modality][index]
+                    tar.add(path, arcname='{:08d}.{}{}'.format(index, modality, os.path.splitext(path)[1].lower()))
+        shards.append({'name': name, 'num_samples': len(indices)})
+    print('[INFO]: Wrote {} shards of ~{} samples'.format(len(shards), samples_per_shard))
+
+    meta = {'version': SHARD_VERSION, 'task': task, 'modalities': modalities, 'num_samples': num_samples,
+            'shards': shards, 'names': [os.path.basename(p) for p in dataset.images]}
+    # shards.json is the completion marker, so it is written last
+    with open(os.path.join(tmp_root, 'shards.json'), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(shard_root):
+        shutil.rmtree(shard_root)
+    os.rename(tmp_root, shard_root)
+
+    return shard_root
+
+
+class SalObjDatasetShards(data.IterableDataset):
+    """Streams tar shards sequentially, shuffling through shard order and a bounded sample buffer.
+
+    Every (rank, worker) split reads an equal contiguous range of the epoch's permuted shard sequence, so
+    all splits yield num_samples // num_splits samples. All workers of all ranks draw the same shard
+    permutation from the DataLoader base seed, so ranks must share the seed (set_seed). get_loader sets
+    num_workers, which __len__ needs.
+    """
+    def __init__(self, shard_root, trainsize, shuffle_buffer=1000, seed=0, device_augment=False, uint8_input=False):
+        with open(os.path.join(shard_root, 'shards.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.shards = [os.path.join(shard_root, s['name']) for s in self.meta['shards']]
+        self.modalities = self.meta['modalities']
+        self.size = self.meta['num_samples']
+        self.trainsize = trainsize
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0   # counts __iter__ calls, persistent workers keep their DataLoader base seed
+        self.num_workers = 0
+        self.augment = PlaneAugment(self.modalities, trainsize, device_augment, uint8_input)
+
+    def get_split(self):
+        rank, world_size = get_rank()
+        info = data.get_worker_info()
+        if info is None:
+            return rank, world_size, self.seed
+        # info.seed is base_seed + worker id, the base seed is shared by the workers of one epoch
+        return rank * info.num_workers + info.id, world_size * info.num_workers, info.seed - info.id
+
+    def iter_shard(self, path):
+        key, members = None, {}
+        with tarfile.open(path, 'r|') as tar:   # pure sequential read
+            for member in tar:
+                if not member.isfile():
+                    continue
+                member_key, modality = member.name.split('.')[:2]
+                if member_key != key and members:
+                    yield key, members
+                    members = {}
+                key = member_key
+                members[modality] = tar.extractfile(member).read()
+        if members:
+            yield key, members
+
+    def split_plan(self, order, split_id, num_splits):
+        # (shard, samples to skip, samples to take) covering this split's range of the permuted sample stream
+        per_split = self.size // num_splits
+        start, end = split_id * per_split, (split_id + 1) * per_split
+        plan, offset = [], 0
+        for i in order:
+            num_samples = self.meta['shards'][i]['num_samples']
+            lo, hi = max(start, offset), min(end, offset + num_samples)
+            if lo < hi:
+                plan.append((self.shards[i], lo - offset, hi - lo))
+            offset += num_samples
+        return plan
+
+    def iter_members(self, plan):
+        for path, skip, take in plan:
+            for key, members in itertools.islice(self.iter_shard(path), skip, skip + take):
+                yield key, members
+
+    def decode(self, key, members):
+        planes = []
+        for modality in self.modalities:
+            img = Image.open(io.BytesIO(members[modality]))
+            if modality == 'image':
+                img.draft('RGB', (self.trainsize, self.trainsize))
+                planes.append(img.convert('RGB'))
+            else:
+                planes.append(img.convert('L'))
+        return self.augment(planes, int(key))
+
+    def __iter__(self):
+        split_id, num_splits, base_seed = self.get_split()
+        self.epoch += 1
+        order = np.random.default_rng([self.seed, base_seed % 2**32, self.epoch]).permutation(len(self.shards))
+        if len(self.shards) < num_splits and split_id == 0 and self.epoch == 1:
+            print('[INFO]: {} shards for {} loader splits, workers share shards and read more data, re-write '
+                  'the shards with more of them'.format(len(self.shards), num_splits))
+        plan = self.split_plan(order, split_id, num_splits)
+        rng = np.random.default_rng([self.seed, base_seed % 2**32, self.epoch, split_id])
+
+        buffer = []
+        for key, members in self.iter_members(plan):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append((key, members))
+                continue
+            # Emit a random buffered sample and keep the new one in its slot
+            j = rng.integers(len(buffer))
+            (key, members), buffer[j] = buffer[j], (key, members)
+            yield self.decode(key, members)
+        for j in rng.permutation(len(buffer)):
+            yield self.decode(*buffer[j])
+
+    def __len__(self):
+        # samples yielded by the splits of this rank
+        num_workers = max(self.num_workers, 1)
+        return num_workers * (self.size // (get_rank()[1] * num_workers))
+
+
+if __name__ == '__main__':
+    # python -m dataset.shards --task SOD
+    from config import param as option
+    from dataset.get_loader import build_dataset
+    modalities = TASK_MODALITIES.get(option['task'], ['image', 'gt'])
+    shard_root = option.get('shard_root') or get_shard_root(option['paths']['image_root'])
+    print('[INFO]: Write [{}] training set shards into {}'.format(option['task'], shard_root))
+    write_shards(build_dataset(option, use_packed=False), shard_root, modalities, option['task'], seed=option['seed'])
@@ -6,6 +6,7 @@ from PIL import Image
 import torch.nn.functional as F
 from config import param as option
 from model.get_model import get_model
+from utils import AsyncImageWriter
 import torchvision.transforms as transforms
 
 
@@ -29,6 +30,7 @@ def rgb_loader(path):
     with open(path, 'rb') as f:
         img = Image.open(f)
         w, h = img.size
+        img.draft('RGB', (384, 384))
         return img_transform(img.convert('RGB')), (w, h)
 
 
@@ -51,6 +53,7 @@ img = img.unsqueeze(0).cuda()
 model, _ = get_model(option)
 model.eval()
 res, vis_feat_list = forward_a_sample(model, img, h, w)
-cv2.imwrite(os.path.join(save_path, 'pred_' + img_path.split('/')[-1]), res)
-for i, feature in enumerate(vis_feat_list):
-    cv2.imwrite(os.path.join(save_path, str(i) + '_' + img_path.split('/')[-1]), feature)
+with AsyncImageWriter() as writer:
+    writer.write(os.path.join(save_path, 'pred_' + img_path.split('/')[-1]), res)
+    for i, feature in enumerate(vis_feat_list):
+        writer.write(os.path.join(save_path, str(i) + '_' + img_path.split('/')[-1]), feature)
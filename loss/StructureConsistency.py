@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import torch.nn as nn
+from utils import float32_forward
 
 
 def ToLabel(E):
@@ -29,6 +30,7 @@ def SSIM(x, y):
     return torch.clamp((1 - SSIM) / 2, 0, 1)
 
 
+@float32_forward
 def SaliencyStructureConsistency(x, y, alpha=0.85):
     ssim = torch.mean(SSIM(x, y))
     l1_loss = torch.mean(torch.abs(x-y))
@@ -49,6 +51,7 @@ def set_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
+@float32_forward
 def depth_loss(pred, target):
     l1_loss = torch.abs(target - pred).sum(dim=1)
     ssim_loss = SSIM(pred, target).sum(dim=1)
@@ -2,9 +2,11 @@ import torch
 import numpy as np
 from loss.structure_loss import structure_loss
 from loss.weakly_loss import weakly_loss
+from utils import float32_forward
 
 
 
+@float32_forward
 def bce_loss_with_sigmoid(pred, gt, weight=None):
     return torch.nn.functional.binary_cross_entropy_with_logits(pred, gt, reduce='none')
 
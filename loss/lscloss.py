@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from utils import float32_forward
 
 
 class LocalSaliencyCoherence(torch.nn.Module):
@@ -15,6 +16,7 @@ class LocalSaliencyCoherence(torch.nn.Module):
         url={http://arxiv.org/abs/1906.04651},
     }
     """
+    @float32_forward
     def forward(
             self, y_hat_softmax, kernels_desc, kernels_radius, sample, height_input, width_input,
             mask_src=None, mask_dst=None, compatibility=None, custom_modality_downsamplers=None, out_kernels_vis=False
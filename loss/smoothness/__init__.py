@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from utils import float32_forward
 # from torch.autograd import Variable
 # import numpy as np
 def laplacian_edge(img):
@@ -58,6 +59,7 @@ class smoothness_loss(torch.nn.Module):
         super(smoothness_loss, self).__init__()
         self.size_average = size_average
 
+    @float32_forward
     def forward(self, pred, target):
 
         return get_saliency_smoothness(pred, target, self.size_average)
@@ -1,7 +1,9 @@
 import torch
 import torch.nn.functional as F
+from utils import float32_forward
 
 
+@float32_forward
 def structure_loss(pred, mask, weight=None):
     def generate_smoothed_gt(gts):
         epsilon = 0.001
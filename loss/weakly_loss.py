@@ -3,6 +3,7 @@ from loss.lscloss import LocalSaliencyCoherence
 from loss.smoothness import smoothness_loss
 from loss.StructureConsistency import SaliencyStructureConsistency as ConsistLoss
 from img_trans import rot_trans
+from utils import float32_forward
 
 
 class weakly_loss():
@@ -10,7 +11,7 @@ class weakly_loss():
         self.lsc_loss = LocalSaliencyCoherence()
         self.smoothness_loss = smoothness_loss(size_average=True)
         self.lsc_kernels = [{"weight": 1, "xy": 6, "rgb": 0.1}]
-        self.cross_entropy = torch.nn.BCELoss()
+        self.cross_entropy = float32_forward(torch.nn.BCELoss())   # BCELoss refuses autocast inputs
         self.lamda = option['grid_search_lamda']
         print('[INFO]: Weakly loss params [{}]'.format(self.lamda))
 
@@ -4,7 +4,9 @@ import torch
 def get_backbone(option):
     if option['backbone'].lower() == 'swin':
         from model.backbone.swin import SwinTransformer
-        backbone = SwinTransformer(img_size=option['trainsize'], embed_dim=128, depths=[2,2,18,2], num_heads=[4,8,16,32], window_size=12)
+        backbone = SwinTransformer(img_size=option['trainsize'], embed_dim=128, depths=[2,2,18,2], num_heads=[4,8,16,32], window_size=12,
+                                   fused_attn=option.get('fused_attn', False),
+                                   use_checkpoint=option.get('grad_ckpt', {}).get('backbone', False))
         pretrained_dict = torch.load(option['pretrain'])["model"]
         pretrained_dict = {k: v for k, v in pretrained_dict.items() if k in backbone.state_dict()}
         backbone.load_state_dict(pretrained_dict)
@@ -17,5 +19,22 @@ def get_backbone(option):
         from model.backbone.DPT import DPT
         backbone = DPT().cuda()
         channel_list = [256, 512, 768, 768]
+    if option['backbone'].lower() != 'swin' and any(option.get('grad_ckpt', {}).get('backbone', [False])):
+        print('[INFO]: Gradient checkpointing of backbone stages is only implemented for swin, ignored')
+
+    if option.get('uint8_input', False):
+        from model.backbone.norm_fold import fold_input_normalization
+        fold_input_normalization(get_input_layer(backbone, option['backbone'].lower()))
 
     return backbone, channel_list
+
+
+def get_input_layer(backbone, name):
+    if name == 'swin':
+        return backbone.patch_embed.proj
+    elif name == 'r50':
+        return backbone.conv1
+    elif name == 'dpt':
+        patch_embed = backbone.pretrained.model.patch_embed
+        # The hybrid ViT runs a ResNet stem before the patch projection
+        return patch_embed.backbone if hasattr(patch_embed, 'backbone') else patch_embed.proj
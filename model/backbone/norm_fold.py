@@ -0,0 +1,36 @@
+import torch
+import torch.nn as nn
+from utils import IMAGE_MEAN, IMAGE_STD, normalize_image
+
+
+class NormFoldConv2d(nn.Conv2d):
+    """Conv2d that also takes uint8 images, with the ImageNet Normalize folded into its weights.
+
+    The fold is computed from the stored parameters at every call, so the state dict is the one of
+    a plain nn.Conv2d and checkpoints load in both input modes. Float inputs take the usual path.
+    """
+    def forward(self, x):
+        if x.dtype != torch.uint8:
+            return super(NormFoldConv2d, self).forward(x)
+        mean = self.weight.new_tensor(IMAGE_MEAN).view(1, -1, 1, 1)
+        std = self.weight.new_tensor(IMAGE_STD).view(1, -1, 1, 1)
+        weight = self.weight / (255 * std)
+        x = x.to(self.weight.dtype)
+        no_padding = self.padding == 'valid' or (not isinstance(self.padding, str) and not any(self.padding))
+        if no_padding:
+            # The mean shift is a constant per output channel
+            bias = -(weight * 255 * mean).sum(dim=(1, 2, 3))
+            bias = bias + self.bias if self.bias is not None else bias
+            return self._conv_forward(x, weight, bias)
+        # A zero-padded normalized image is an image padded with the mean in pixel space
+        return self._conv_forward(x - 255 * mean, weight, self.bias)
+
+
+def fold_input_normalization(module):
+    """Let `module`, the first layer of a backbone, take uint8 images directly."""
+    if type(module) is nn.Conv2d:
+        module.__class__ = NormFoldConv2d
+    else:
+        # e.g. timm's weight-standardized stem conv, the standardization does not commute with the fold
+        module.register_forward_pre_hook(lambda m, inputs: (normalize_image(inputs[0]),) + tuple(inputs[1:]))
+    return module
@@ -5,10 +5,22 @@
 # Written by Ze Liu
 # --------------------------------------------------------
 
+import functools
+from collections import OrderedDict
 import torch
 import torch.nn as nn
-import torch.utils.checkpoint as checkpoint
+import torch.nn.functional as F
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
+from model.blocks.grad_checkpoint import checkpoint_call
+
+
+# SW-MSA masks kept in the LRU cache, one per (padded resolution, window, shift, device)
+MASK_CACHE_SIZE = 32
+# Window gather maps, one per (resolution, window, shift, device), two layouts per stage
+INDEX_CACHE_SIZE = 64
+# Combined bias + mask tensors kept per WindowAttention for inference, one per resolution
+ATTN_BIAS_CACHE_SIZE = 4
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
 
 
 class Mlp(nn.Module):
@@ -62,6 +74,84 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+def compute_attn_mask(H, W, window_size, shift_size, device=None):
+    """
+    Args:
+        H, W (int): Padded feature size, multiples of window_size
+        window_size (int): Window size
+        shift_size (int): Shift size for SW-MSA
+
+    Returns:
+        attn_mask: (0/-100) mask with shape of (num_windows, Wh*Ww, Wh*Ww)
+    """
+    img_mask = torch.zeros((1, H, W, 1), device=device)  # 1 H W 1
+    h_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    w_slices = (slice(0, -window_size),
+                slice(-window_size, -shift_size),
+                slice(-shift_size, None))
+    cnt = 0
+    for h in h_slices:
+        for w in w_slices:
+            img_mask[:, h, w, :] = cnt
+            cnt += 1
+
+    mask_windows = window_partition(img_mask, window_size)  # nW, window_size, window_size, 1
+    mask_windows = mask_windows.view(-1, window_size * window_size)
+    attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
+    attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+    return attn_mask
+
+
+def get_window_layout(H, W, window_size, shift_size):
+    """
+    Window layout of one block at feature resolution (H, W), the window shrinks to the feature
+    map when it does not fit (no shift then), otherwise the features are padded to window multiples.
+
+    Returns:
+        window_size, shift_size, Hp, Wp (padded resolution)
+    """
+    if min(H, W) <= window_size:
+        window_size, shift_size = min(H, W), 0
+    Hp = -(-H // window_size) * window_size
+    Wp = -(-W // window_size) * window_size
+    return window_size, shift_size, Hp, Wp
+
+
+@functools.lru_cache(maxsize=INDEX_CACHE_SIZE)
+def get_window_index(H, W, window_size, shift_size, device):
+    """
+    Gather maps replacing cyclic shift + window_partition and window_reverse + reverse shift + crop.
+
+    Args:
+        H, W (int): Feature size before padding
+        window_size, shift_size (int): Window layout, see get_window_layout
+
+    Returns:
+        index: (Hp*Wp,) padded (H, W) position of every token in shifted window order
+        inverse: (H*W,) window order position of every unpadded token
+        both None when the window order is the token order (one window per row, no shift / padding)
+    """
+    _, _, Hp, Wp = get_window_layout(H, W, window_size, shift_size)
+    positions = torch.arange(Hp * Wp).view(1, Hp, Wp, 1)
+    if shift_size > 0:
+        positions = torch.roll(positions, shifts=(-shift_size, -shift_size), dims=(1, 2))
+    index = window_partition(positions, window_size).reshape(-1)
+    inverse = torch.empty_like(index)
+    inverse[index] = torch.arange(Hp * Wp)
+    inverse = inverse.view(Hp, Wp)[:H, :W].reshape(-1)
+    if torch.equal(index, torch.arange(H * W)):
+        return None, None
+    return index.to(device), inverse.to(device)
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def get_attn_mask(Hp, Wp, window_size, shift_size, device):
+    # Cached per padded resolution, the mask is shared and must not be modified in place
+    return compute_attn_mask(Hp, Wp, window_size, shift_size, device=device)
+
+
 class WindowAttention(nn.Module):
     r""" Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -74,9 +164,11 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        fused_attn (bool, optional): Use F.scaled_dot_product_attention when available. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.,
+                 fused_attn=False):
 
         super().__init__()
         self.dim = dim
@@ -84,6 +176,10 @@ class WindowAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim ** -0.5
+        self.fused_attn = fused_attn and HAS_SDPA
+        # torch 2.0 has no scale argument, its default is head_dim ** -0.5
+        self.sdpa_kwargs = {} if qk_scale is None else {'scale': self.scale}
+        self.attn_bias_cache = OrderedDict()
 
         # define a parameter table of relative position bias
         self.relative_position_bias_table = nn.Parameter(
@@ -109,23 +205,98 @@ class WindowAttention(nn.Module):
 
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
+        self.sub_window_index = {}
+
+    def get_relative_position_index(self, window_size):
+        """Index into the bias table for a square window smaller than self.window_size (low resolutions)."""
+        if window_size == self.window_size:
+            return self.relative_position_index
+        key = (window_size, self.relative_position_index.device)
+        if key not in self.sub_window_index:
+            coords_h = torch.arange(window_size[0])
+            coords_w = torch.arange(window_size[1])
+            coords_flatten = torch.flatten(torch.stack(torch.meshgrid([coords_h, coords_w])), 1)  # 2, wh*ww
+            relative_coords = (coords_flatten[:, :, None] - coords_flatten[:, None, :]).permute(1, 2, 0).contiguous()
+            # same offsets and row stride as the full window, so the pretrained table is reused
+            relative_coords[:, :, 0] += self.window_size[0] - 1
+            relative_coords[:, :, 1] += self.window_size[1] - 1
+            relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
+            self.sub_window_index[key] = relative_coords.sum(-1).to(key[1])
+        return self.sub_window_index[key]
+
+    def get_relative_position_bias(self, window_size):
+        relative_position_index = self.get_relative_position_index(window_size)
+        relative_position_bias = self.relative_position_bias_table[relative_position_index.view(-1)].view(
+            window_size[0] * window_size[1], window_size[0] * window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def get_attn_bias(self, window_size, mask, dtype):
+        """
+        Relative position bias + SW-MSA mask as one additive tensor, (nW or 1, nH, N, N).
+
+        Rebuilt at every call while training. In eval mode or without autograd it is cached per
+        (window, mask) and detached, so the table counts as frozen in eval mode. The table version
+        counter invalidates the cache after optimizer steps or load_state_dict.
+        """
+        cacheable = not self.training or not torch.is_grad_enabled()
+        key = (window_size, id(mask), dtype, self.relative_position_bias_table._version)
+        if cacheable and key in self.attn_bias_cache:
+            self.attn_bias_cache.move_to_end(key)
+            return self.attn_bias_cache[key][1]
 
-    def forward(self, x, mask=None):
+        attn_bias = self.get_relative_position_bias(window_size).unsqueeze(0)
+        if mask is not None:
+            attn_bias = attn_bias + mask.unsqueeze(1)
+        attn_bias = attn_bias.to(dtype)
+        if cacheable:
+            attn_bias = attn_bias.detach()
+            # the mask is kept alive with its bias, so its id is not reused while cached
+            self.attn_bias_cache[key] = (mask, attn_bias)
+            while len(self.attn_bias_cache) > ATTN_BIAS_CACHE_SIZE:
+                self.attn_bias_cache.popitem(last=False)
+        return attn_bias
+
+    def forward_fused(self, qkv, mask, window_size):
+        """
+        Args:
+            qkv: output of self.qkv with shape of (num_windows*B, N, 3*C)
+        Returns:
+            x: attention output with shape of (num_windows*B, N, C)
+        """
+        B_, N, _ = qkv.shape
+        nH, head_dim = self.num_heads, self.dim // self.num_heads
+        attn_bias = self.get_attn_bias(window_size, mask, qkv.dtype)
+        nW = attn_bias.shape[0]
+        # The windows of one image go into the head dim, (B, nW*nH, N, hd), so the bias only
+        # broadcasts over the batch and SDPA keeps its fused 4D kernels
+        qkv = qkv.view(B_ // nW, nW, N, 3, nH, head_dim).permute(3, 0, 1, 4, 2, 5)
+        q, k, v = [t.reshape(B_ // nW, nW * nH, N, head_dim) for t in qkv]
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias.view(1, nW * nH, N, N),
+                                           dropout_p=self.attn_drop.p if self.training else 0., **self.sdpa_kwargs)
+        return x.view(B_ // nW, nW, nH, N, head_dim).permute(0, 1, 3, 2, 4).reshape(B_, N, nH * head_dim)
+
+    def forward(self, x, mask=None, window_size=None):
         """
         Args:
             x: input features with shape of (num_windows*B, N, C)
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+            window_size (tuple[int] | None): actual window when shrunk below self.window_size
         """
         B_, N, C = x.shape
+        window_size = window_size or self.window_size
+        if self.fused_attn:
+            x = self.forward_fused(self.qkv(x), mask, window_size)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = self.get_relative_position_bias(window_size)
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -166,9 +337,8 @@ class SwinTransformerBlock(nn.Module):
 
     Args:
         dim (int): Number of input channels.
-        input_resolution (tuple[int]): Input resulotion.
         num_heads (int): Number of attention heads.
-        window_size (int): Window size.
+        window_size (int): Window size, shrunk per forward to feature maps smaller than it.
         shift_size (int): Shift size for SW-MSA.
         mlp_ratio (float): Ratio of mlp hidden dim to embedding dim.
         qkv_bias (bool, optional): If True, add a learnable bias to query, key, value. Default: True
@@ -178,92 +348,70 @@ class SwinTransformerBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        fused_attn (bool, optional): Use F.scaled_dot_product_attention when available. Default: False
     """
 
-    def __init__(self, dim, input_resolution, num_heads, window_size=7, shift_size=0,
+    def __init__(self, dim, num_heads, window_size=7, shift_size=0,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0., drop_path=0.,
-                 act_layer=nn.GELU, norm_layer=nn.LayerNorm):
+                 act_layer=nn.GELU, norm_layer=nn.LayerNorm, fused_attn=False):
         super().__init__()
         self.dim = dim
-        self.input_resolution = input_resolution
         self.num_heads = num_heads
         self.window_size = window_size
         self.shift_size = shift_size
         self.mlp_ratio = mlp_ratio
-        if min(self.input_resolution) <= self.window_size:
-            # if window size is larger than input resolution, we don't partition windows
-            self.shift_size = 0
-            self.window_size = min(self.input_resolution)
         assert 0 <= self.shift_size < self.window_size, "shift_size must in 0-window_size"
 
         self.norm1 = norm_layer(dim)
         self.attn = WindowAttention(
             dim, window_size=to_2tuple(self.window_size), num_heads=num_heads,
-            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, fused_attn=fused_attn)
 
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
 
-        if self.shift_size > 0:
-            # calculate attention mask for SW-MSA
-            H, W = self.input_resolution
-            img_mask = torch.zeros((1, H, W, 1))  # 1 H W 1
-            h_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            w_slices = (slice(0, -self.window_size),
-                        slice(-self.window_size, -self.shift_size),
-                        slice(-self.shift_size, None))
-            cnt = 0
-            for h in h_slices:
-                for w in w_slices:
-                    img_mask[:, h, w, :] = cnt
-                    cnt += 1
-
-            mask_windows = window_partition(img_mask, self.window_size)  # nW, window_size, window_size, 1
-            mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
-            attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-            attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
-        else:
-            attn_mask = None
+        # SW-MSA masks are built per resolution (get_attn_mask), checkpoints of the fixed
+        # resolution model still carry an attn_mask buffer, which is dropped on load
+        self._register_load_state_dict_pre_hook(self._drop_attn_mask)
 
-        self.register_buffer("attn_mask", attn_mask)
+    @staticmethod
+    def _drop_attn_mask(state_dict, prefix, *args):
+        state_dict.pop(prefix + 'attn_mask', None)
 
-    def forward(self, x):
-        H, W = self.input_resolution
+    def forward(self, x, H, W):
+        """
+        Args:
+            x: input features with shape of (B, H*W, C)
+            H, W: spatial resolution of the input features
+        """
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
+        window_size, shift_size, Hp, Wp = get_window_layout(H, W, self.window_size, self.shift_size)
 
         shortcut = x
         x = self.norm1(x)
-        x = x.view(B, H, W, C)
 
-        # cyclic shift
-        if self.shift_size > 0:
-            shifted_x = torch.roll(x, shifts=(-self.shift_size, -self.shift_size), dims=(1, 2))
-        else:
-            shifted_x = x
+        # pad feature maps to multiples of window size
+        pad_r, pad_b = Wp - W, Hp - H
+        if pad_r > 0 or pad_b > 0:
+            x = F.pad(x.view(B, H, W, C), (0, 0, 0, pad_r, 0, pad_b)).view(B, Hp * Wp, C)
 
-        # partition windows
-        x_windows = window_partition(shifted_x, self.window_size)  # nW*B, window_size, window_size, C
-        x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
+        # cyclic shift + partition windows in one gather
+        index, inverse = get_window_index(H, W, window_size, shift_size, x.device)
+        attn_mask = get_attn_mask(Hp, Wp, window_size, shift_size, x.device) if shift_size > 0 else None
+        if index is not None:
+            x = x.index_select(1, index)
+        x_windows = x.view(-1, window_size * window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=self.attn_mask)  # nW*B, window_size*window_size, C
+        attn_windows = self.attn(x_windows, mask=attn_mask, window_size=to_2tuple(window_size))  # nW*B, window_size*window_size, C
 
-        # merge windows
-        attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
-        shifted_x = window_reverse(attn_windows, self.window_size, H, W)  # B H' W' C
-        # import pdb; pdb.set_trace()
-
-        # reverse cyclic shift
-        if self.shift_size > 0:
-            x = torch.roll(shifted_x, shifts=(self.shift_size, self.shift_size), dims=(1, 2))
-        else:
-            x = shifted_x
-        x = x.view(B, H * W, C)
+        # merge windows + reverse cyclic shift + crop the padding in one gather
+        x = attn_windows.view(B, Hp * Wp, C)
+        if inverse is not None:
+            x = x.index_select(1, inverse)  # B, H*W, C
 
         # FFN
         x = shortcut + self.drop_path(x)
@@ -272,17 +420,17 @@ class SwinTransformerBlock(nn.Module):
         return x
 
     def extra_repr(self) -> str:
-        return f"dim={self.dim}, input_resolution={self.input_resolution}, num_heads={self.num_heads}, " \
+        return f"dim={self.dim}, num_heads={self.num_heads}, " \
                f"window_size={self.window_size}, shift_size={self.shift_size}, mlp_ratio={self.mlp_ratio}"
 
-    def flops(self):
+    def flops(self, H, W):
         flops = 0
-        H, W = self.input_resolution
+        window_size, _, Hp, Wp = get_window_layout(H, W, self.window_size, self.shift_size)
         # norm1
         flops += self.dim * H * W
         # W-MSA/SW-MSA
-        nW = H * W / self.window_size / self.window_size
-        flops += nW * self.attn.flops(self.window_size * self.window_size)
+        nW = Hp * Wp / window_size / window_size
+        flops += nW * self.attn.flops(window_size * window_size)
         # mlp
         flops += 2 * H * W * self.dim * self.dim * self.mlp_ratio
         # norm2
@@ -294,29 +442,29 @@ class PatchMerging(nn.Module):
     r""" Patch Merging Layer.
 
     Args:
-        input_resolution (tuple[int]): Resolution of input feature.
         dim (int): Number of input channels.
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
     """
 
-    def __init__(self, input_resolution, dim, norm_layer=nn.LayerNorm):
+    def __init__(self, dim, norm_layer=nn.LayerNorm):
         super().__init__()
-        self.input_resolution = input_resolution
         self.dim = dim
         self.reduction = nn.Linear(4 * dim, 2 * dim, bias=False)
         self.norm = norm_layer(4 * dim)
 
-    def forward(self, x):
+    def forward(self, x, H, W):
         """
         x: B, H*W, C
         """
-        H, W = self.input_resolution
         B, L, C = x.shape
         assert L == H * W, "input feature has wrong size"
-        assert H % 2 == 0 and W % 2 == 0, f"x size ({H}*{W}) are not even."
 
         x = x.view(B, H, W, C)
 
+        # padding
+        if H % 2 == 1 or W % 2 == 1:
+            x = F.pad(x, (0, 0, 0, W % 2, 0, H % 2))
+
         x0 = x[:, 0::2, 0::2, :]  # B H/2 W/2 C
         x1 = x[:, 1::2, 0::2, :]  # B H/2 W/2 C
         x2 = x[:, 0::2, 1::2, :]  # B H/2 W/2 C
@@ -330,10 +478,9 @@ class PatchMerging(nn.Module):
         return x
 
     def extra_repr(self) -> str:
-        return f"input_resolution={self.input_resolution}, dim={self.dim}"
+        return f"dim={self.dim}"
 
-    def flops(self):
-        H, W = self.input_resolution
+    def flops(self, H, W):
         flops = H * W * self.dim
         flops += (H // 2) * (W // 2) * 4 * self.dim * 2 * self.dim
         return flops
@@ -344,7 +491,6 @@ class BasicLayer(nn.Module):
 
     Args:
         dim (int): Number of input channels.
-        input_resolution (tuple[int]): Input resolution.
         depth (int): Number of blocks.
         num_heads (int): Number of attention heads.
         window_size (int): Local window size.
@@ -357,55 +503,64 @@ class BasicLayer(nn.Module):
         norm_layer (nn.Module, optional): Normalization layer. Default: nn.LayerNorm
         downsample (nn.Module | None, optional): Downsample layer at the end of the layer. Default: None
         use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False.
+        fused_attn (bool): Use F.scaled_dot_product_attention when available. Default: False
     """
 
-    def __init__(self, dim, input_resolution, depth, num_heads, window_size,
+    def __init__(self, dim, depth, num_heads, window_size,
                  mlp_ratio=4., qkv_bias=True, qk_scale=None, drop=0., attn_drop=0.,
-                 drop_path=0., norm_layer=nn.LayerNorm, downsample=None, use_checkpoint=False):
+                 drop_path=0., norm_layer=nn.LayerNorm, downsample=None, use_checkpoint=False, fused_attn=False):
 
         super().__init__()
         self.dim = dim
-        self.input_resolution = input_resolution
         self.depth = depth
         self.use_checkpoint = use_checkpoint
 
         # build blocks
         self.blocks = nn.ModuleList([
-            SwinTransformerBlock(dim=dim, input_resolution=input_resolution,
+            SwinTransformerBlock(dim=dim,
                                  num_heads=num_heads, window_size=window_size,
                                  shift_size=0 if (i % 2 == 0) else window_size // 2,
                                  mlp_ratio=mlp_ratio,
                                  qkv_bias=qkv_bias, qk_scale=qk_scale,
                                  drop=drop, attn_drop=attn_drop,
                                  drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,
-                                 norm_layer=norm_layer)
+                                 norm_layer=norm_layer, fused_attn=fused_attn)
             for i in range(depth)])
 
         # patch merging layer
         if downsample is not None:
-            self.downsample = downsample(input_resolution, dim=dim, norm_layer=norm_layer)
+            self.downsample = downsample(dim=dim, norm_layer=norm_layer)
         else:
             self.downsample = None
 
-    def forward(self, x):
+    def forward(self, x, H, W):
+        """
+        Args:
+            x: input features with shape of (B, H*W, C)
+            H, W: spatial resolution of the input features
+
+        Returns:
+            x, H, W: output features and their resolution, halved by the downsample layer
+        """
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint_call(blk, x, H, W)
             else:
-                x = blk(x)
+                x = blk(x, H, W)
         if self.downsample is not None:
-            x = self.downsample(x)
-        return x
+            x = self.downsample(x, H, W)
+            H, W = (H + 1) // 2, (W + 1) // 2
+        return x, H, W
 
     def extra_repr(self) -> str:
-        return f"dim={self.dim}, input_resolution={self.input_resolution}, depth={self.depth}"
+        return f"dim={self.dim}, depth={self.depth}"
 
-    def flops(self):
+    def flops(self, H, W):
         flops = 0
         for blk in self.blocks:
-            flops += blk.flops()
+            flops += blk.flops(H, W)
         if self.downsample is not None:
-            flops += self.downsample.flops()
+            flops += self.downsample.flops(H, W)
         return flops
 
 
@@ -441,9 +596,11 @@ class PatchEmbed(nn.Module):
 
     def forward(self, x):
         B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # padding
+        if W % self.patch_size[1] != 0:
+            x = F.pad(x, (0, self.patch_size[1] - W % self.patch_size[1]))
+        if H % self.patch_size[0] != 0:
+            x = F.pad(x, (0, 0, 0, self.patch_size[0] - H % self.patch_size[0]))
         x = self.proj(x).flatten(2).transpose(1, 2)  # B Ph*Pw C
         if self.norm is not None:
             x = self.norm(x)
@@ -480,7 +637,8 @@ class SwinTransformer(nn.Module):
         norm_layer (nn.Module): Normalization layer. Default: nn.LayerNorm.
         ape (bool): If True, add absolute position embedding to the patch embedding. Default: False
         patch_norm (bool): If True, add normalization after patch embedding. Default: True
-        use_checkpoint (bool): Whether to use checkpointing to save memory. Default: False
+        use_checkpoint (bool | list[bool]): Whether to use checkpointing to save memory, for all or per stage. Default: False
+        fused_attn (bool): Use F.scaled_dot_product_attention when available. Default: False
     """
 
     def __init__(self, img_size=224, patch_size=4, in_chans=3, num_classes=1000,
@@ -488,7 +646,7 @@ class SwinTransformer(nn.Module):
                  window_size=7, mlp_ratio=4., qkv_bias=True, qk_scale=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0.1,
                  norm_layer=nn.LayerNorm, ape=False, patch_norm=True,
-                 use_checkpoint=False, **kwargs):
+                 use_checkpoint=False, fused_attn=False, **kwargs):
         super().__init__()
 
         self.num_classes = num_classes
@@ -516,13 +674,13 @@ class SwinTransformer(nn.Module):
 
         # stochastic depth
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]  # stochastic depth decay rule
+        if isinstance(use_checkpoint, bool):
+            use_checkpoint = [use_checkpoint] * self.num_layers
 
         # build layers
         self.layers = nn.ModuleList()
         for i_layer in range(self.num_layers):
             layer = BasicLayer(dim=int(embed_dim * 2 ** i_layer),
-                               input_resolution=(patches_resolution[0] // (2 ** i_layer),
-                                                 patches_resolution[1] // (2 ** i_layer)),
                                depth=depths[i_layer],
                                num_heads=num_heads[i_layer],
                                window_size=window_size,
@@ -532,7 +690,7 @@ class SwinTransformer(nn.Module):
                                drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer + 1])],
                                norm_layer=norm_layer,
                                downsample=PatchMerging if (i_layer < self.num_layers - 1) else None,
-                               use_checkpoint=use_checkpoint)
+                               use_checkpoint=use_checkpoint[i_layer], fused_attn=fused_attn)
             self.layers.append(layer)
 
         # self.norm = norm_layer(self.num_features)
@@ -562,15 +720,18 @@ class SwinTransformer(nn.Module):
         num_passed = 0
         features = []
 
+        # any input size, the token grid is the padded size / patch size
+        Wh = -(-x.shape[2] // self.patch_embed.patch_size[0])
+        Ww = -(-x.shape[3] // self.patch_embed.patch_size[1])
         x = self.patch_embed(x)
         if self.ape:
             x = x + self.absolute_pos_embed
         x = self.pos_drop(x)
 
         for layer in self.layers:
-            features.append(self.resize_feat(x, num_passed))
+            features.append(self.resize_feat(x, Wh, Ww, num_passed))
             num_passed += 1
-            x = layer(x)
+            x, Wh, Ww = layer(x, Wh, Ww)
 
         # features.append(self.resize_feat(x, num_passed-1))
 
@@ -579,10 +740,8 @@ class SwinTransformer(nn.Module):
         # x = torch.flatten(x, 1)
         return features
     
-    def resize_feat(self, x, num_passed):
-        sizes = [96, 48, 24, 12, 12]
-        size = sizes[num_passed]
-        resize_x = x.view(-1, size, size, self.num_features[num_passed]).permute(0, 3, 1, 2).contiguous()
+    def resize_feat(self, x, H, W, num_passed):
+        resize_x = x.view(-1, H, W, self.num_features[num_passed]).permute(0, 3, 1, 2).contiguous()
         return resize_x
 
     def forward(self, x):
@@ -590,11 +749,14 @@ class SwinTransformer(nn.Module):
         # x = self.head(x)
         return x
 
-    def flops(self):
+    def flops(self, img_size=None):
+        # at the construction img_size unless given, any (H, W) runs
+        H, W = to_2tuple(img_size) if img_size is not None else self.patch_embed.img_size
+        Wh, Ww = -(-H // self.patch_embed.patch_size[0]), -(-W // self.patch_embed.patch_size[1])
         flops = 0
         flops += self.patch_embed.flops()
         for i, layer in enumerate(self.layers):
-            flops += layer.flops()
-        flops += self.num_features * self.patches_resolution[0] * self.patches_resolution[1] // (2 ** self.num_layers)
-        flops += self.num_features * self.num_classes
+            flops += layer.flops(Wh, Ww)
+            Wh, Ww = (Wh + 1) // 2, (Ww + 1) // 2
+        # no final norm / classification head in this backbone
         return flops
@@ -0,0 +1,25 @@
+import inspect
+import torch
+import torch.utils.checkpoint as checkpoint
+
+
+# torch >= 1.11 takes use_reentrant, the non-reentrant variant also tracks grads of list / non-tensor inputs
+CHECKPOINT_KWARGS = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(checkpoint.checkpoint).parameters else {}
+
+
+def checkpoint_call(function, *args):
+    """function(*args), activations are recomputed in backward instead of stored, only while autograd records."""
+    if not torch.is_grad_enabled():
+        return function(*args)
+    return checkpoint.checkpoint(function, *args, **CHECKPOINT_KWARGS)
+
+
+def checkpoint_features(module, features, enabled=True):
+    """Neck / decoder call on a list of feature maps, checkpointed as one segment when enabled.
+
+    BatchNorm layers inside the segment update their running stats again during the recompute.
+    """
+    if not enabled or not module.training:
+        return module(features)
+    outputs = checkpoint_call(lambda *feats: tuple(module(list(feats))), *features)
+    return list(outputs)
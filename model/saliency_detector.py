@@ -2,11 +2,12 @@ import copy
 import torch
 import torch.nn as nn
 import torch.nn.utils.spectral_norm as sn
-from utils import torch_tile, reparametrize
+from utils import torch_tile, reparametrize, normalize_image, float32_forward
 from model.backbone.get_backbone import get_backbone
 from model.neck.get_neck import get_neck
 from model.decoder.get_decoder import get_decoder
 from model.depth_module.get_depth_module import get_depth_module
+from model.blocks.grad_checkpoint import checkpoint_features
 
 from model.blocks.base_blocks import FeatureFusionBlock
 
@@ -20,11 +21,18 @@ class sod_model(torch.nn.Module):
         self.decoder = get_decoder(option)
         self.depth_module = get_depth_module(option, self.channel_list)
         self.noise_model = noise_model(option)   # For abp
+        self.grad_ckpt = option.get('grad_ckpt', {})
+        self.latent_dim = option['latent_dim']
 
     def forward(self, img, z=None, gts=None, depth=None):
+        return self.decode(self.encode(img, depth), z)
+
+    def encode(self, img, depth=None):
+        """Everything of forward() that does not depend on z: backbone, neck and the depth branches."""
+        depth_features, outputs_depth = None, None
         if depth is not None:
             if 'head' in self.depth_module.keys():
-                img = self.depth_module['head'](img, depth)
+                img = self.depth_module['head'](normalize_image(img), depth)
             elif 'feature' in self.depth_module.keys():
                 depth_features = self.depth_module['feature'](depth)
             elif 'rgb' in self.depth_module.keys():
@@ -32,23 +40,36 @@ class sod_model(torch.nn.Module):
 
         ## Backbone
         backbone_features = self.backbone(img)
-        
+
         ## Neck
-        neck_features = self.neck(backbone_features)
+        neck_features = checkpoint_features(self.neck, backbone_features, self.grad_ckpt.get('neck', False))
+
+        if depth is not None and 'aux_decoder' in self.depth_module.keys():
+            outputs_depth = self.depth_module['aux_decoder'](backbone_features)
+        return {'backbone_features': backbone_features, 'neck_features': neck_features,
+                'depth_features': depth_features, 'depth_pre': outputs_depth}
 
+    def decode(self, features, z=None):
+        """noise_model + decoder on encode() features, which are reused as is, e.g. for several z."""
+        neck_features = list(features['neck_features'])   # noise_model replaces the last one in place
         if z is not None:
             neck_features = self.noise_model(z, neck_features)
 
-        if depth is not None and 'fusion' in self.depth_module.keys():
-            neck_features = self.depth_module['fusion'](neck_features, depth_features)
+        if features['depth_features'] is not None and 'fusion' in self.depth_module.keys():
+            neck_features = self.depth_module['fusion'](neck_features, features['depth_features'])
 
         ## Decoder
-        outputs = self.decoder(neck_features)
-        if depth is not None and 'aux_decoder' in self.depth_module.keys():
-            outputs_depth = self.depth_module['aux_decoder'](backbone_features)
-            return {'sal_pre': outputs, 'depth_pre': outputs_depth, 'backbone_features':backbone_features}
-        else:
-            return {'sal_pre': outputs, 'depth_pre': None, 'backbone_features':backbone_features}
+        outputs = checkpoint_features(self.decoder, neck_features, self.grad_ckpt.get('decoder', False))
+        return {'sal_pre': outputs, 'depth_pre': features['depth_pre'], 'backbone_features': features['backbone_features']}
+
+    def sample(self, img, K, depth=None):
+        """K predictions per image from z ~ N(0, I), the backbone and neck run once and only noise_model +
+        decoder run on the B*K batch. Returns the per-sample saliency maps, their mean and its entropy."""
+        features = self.encode(img, depth)
+        features['neck_features'] = repeat_samples(features['neck_features'], K)
+        features['depth_features'] = repeat_samples(features['depth_features'], K)
+        z = torch.randn(img.shape[0] * K, self.latent_dim, device=img.device)
+        return sample_statistics(self.decode(features, z)['sal_pre'][-1], K)
 
 
 class sod_model_with_vae(torch.nn.Module):
@@ -62,31 +83,59 @@ class sod_model_with_vae(torch.nn.Module):
         self.vae_model = vae_model(option)
         self.decoder_post = copy.deepcopy(self.decoder_prior)
         self.neck_post = copy.deepcopy(self.neck_prior)
+        self.grad_ckpt = option.get('grad_ckpt', {})
 
     def forward(self, img, z=None, gts=None, depth=None):
         if depth is not None:
             if 'head' in self.depth_module.keys():
-                img = self.depth_module['head'](img, depth)
+                img = self.depth_module['head'](normalize_image(img), depth)
             elif 'feature' in self.depth_module.keys():
                 depth_features = self.depth_module['feature'](depth)
         
         backbone_features = self.backbone(img)
-        neck_features_prior = self.neck_prior(backbone_features)
-        neck_features_post = self.neck_post(backbone_features)
-        vae_model_input = [img, neck_features_prior, neck_features_post, gts]
+        neck_features_prior = checkpoint_features(self.neck_prior, backbone_features, self.grad_ckpt.get('neck', False))
+        neck_features_post = checkpoint_features(self.neck_post, backbone_features, self.grad_ckpt.get('neck', False))
+        vae_model_input = [normalize_image(img), neck_features_prior, neck_features_post, gts]
         neck_features_z_prior, neck_features_z_post, kld = self.vae_model(*vae_model_input)
         # if depth is not None and 'fusion' in self.depth_module.keys():
         #     neck_features = self.depth_module['fusion'](neck_features, depth_features)
 
         if gts is not None:   # In the training case with gt
-            outputs_prior = self.decoder_prior(neck_features_z_prior)
-            outputs_post = self.decoder_post(neck_features_z_post)
+            outputs_prior = checkpoint_features(self.decoder_prior, neck_features_z_prior, self.grad_ckpt.get('decoder', False))
+            outputs_post = checkpoint_features(self.decoder_post, neck_features_z_post, self.grad_ckpt.get('decoder', False))
 
             return outputs_prior, outputs_post, kld
         else:   # In the testing case without gt
-            outputs = self.decoder_prior(neck_features_z_prior)
+            outputs = checkpoint_features(self.decoder_prior, neck_features_z_prior, self.grad_ckpt.get('decoder', False))
             return {'sal_pre': outputs, 'depth_pre': None, 'backbone_features':backbone_features}
 
+    def sample(self, img, K, depth=None):
+        """K predictions per image from z ~ prior(z | img), the backbone, neck and prior encoder run once."""
+        if depth is not None and 'head' in self.depth_module.keys():
+            img = self.depth_module['head'](normalize_image(img), depth)
+        neck_features = self.neck_prior(self.backbone(img))
+        mu_prior, logvar_prior, _ = self.vae_model.enc_x(normalize_image(img))
+        z_prior = reparametrize(repeat_samples(mu_prior, K), repeat_samples(logvar_prior, K))
+        neck_features = self.vae_model.noise_model_prior(z_prior, repeat_samples(neck_features, K))
+        return sample_statistics(self.decoder_prior(neck_features)[-1], K)
+
+
+def repeat_samples(features, K):
+    # (B, ...) -> (B*K, ...), the K copies of a sample next to each other
+    if features is None:
+        return None
+    if isinstance(features, (list, tuple)):
+        return [repeat_samples(f, K) for f in features]
+    return features.repeat_interleave(K, dim=0)
+
+
+def sample_statistics(logits, K):
+    samples = torch.sigmoid(logits.float()).view(-1, K, *logits.shape[1:])
+    mean = samples.mean(1)
+    # binary predictive entropy, in [0, ln 2]
+    entropy = -(mean * torch.log(mean.clamp(min=1e-8)) + (1 - mean) * torch.log((1 - mean).clamp(min=1e-8)))
+    return {'mean': mean, 'samples': samples, 'entropy': entropy}
+
 
 class vae_model(nn.Module):
     def __init__(self, option):
@@ -113,7 +162,7 @@ class vae_model(nn.Module):
             z_post = reparametrize(mu_post, logvar_post)
             neck_features_z_post = self.noise_model_post(z_post, neck_features_post)
 
-            kld = torch.mean(torch.distributions.kl.kl_divergence(dist_post, dist_prior))
+            kld = latent_kl(dist_post, dist_prior)
             return neck_features_z_prior, neck_features_z_post, kld
 
 
@@ -201,11 +250,22 @@ class encode_for_vae(nn.Module):
 
         mu = self.fc1(output)
         logvar = self.fc2(output)
-        dist = torch.distributions.Independent(torch.distributions.Normal(loc=mu, scale=torch.exp(logvar)), 1)
+        dist = latent_distribution(mu, logvar)
 
         return mu, logvar, dist
 
 
+# The latent gaussians and their KL stay in fp32 under autocast, exp(logvar) overflows fp16
+@float32_forward
+def latent_distribution(mu, logvar):
+    return torch.distributions.Independent(torch.distributions.Normal(loc=mu, scale=torch.exp(logvar)), 1)
+
+
+@float32_forward
+def latent_kl(dist_post, dist_prior):
+    return torch.mean(torch.distributions.kl.kl_divergence(dist_post, dist_prior))
+
+
 class ebm_prior(nn.Module):
     def __init__(self, ebm_out_dim, ebm_middle_dim, latent_dim):
         super().__init__()
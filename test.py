@@ -6,12 +6,17 @@ from torchvision import transforms
 import pandas as pd
 import numpy as np
 import pdb, os, argparse
-from dataset.dataloader import test_dataset, eval_Dataset, test_dataset_rgbd
+from dataset.dataloader import eval_Dataset
+from dataset.get_loader import get_test_loader
 from tqdm import tqdm
 # from model.DPT import DPTSegmentationModel
 from config import param as option
 from model.get_model import get_model
-from utils import sample_p_0, DotDict
+from utils import sample_p_0, DotDict, AsyncImageWriter, RunningStats
+from trainer.trainer_ebm import ebm_samplers, prior_energy
+
+
+STOCHASTIC_METHODS = ['gan', 'ganabp', 'abp', 'vae']   # tested with test_samples latent draws per image
 
 
 def eval_mae(loader, cuda=True):
@@ -37,9 +42,10 @@ class Tester():
         self.model, self.uncertainty_model = get_model(option)
         self.model.load_state_dict(torch.load(option['checkpoint']))
         self.model.eval()
-        # if self.uncertainty_model is not None:
-        #     self.uncertainty_model.load_state_dict(torch.load(option['checkpoint'].replace('generator', 'ebm_model')))
-        #     self.uncertainty_model.eval()
+        if self.option['uncer_method'] == 'ebm':
+            self.uncertainty_model.load_state_dict(torch.load(option['checkpoint'].replace('generator', 'ebm_model')))
+            self.uncertainty_model.eval()
+            self.prior_sampler = ebm_samplers(option)[0]
 
     def prepare_test_params(self, dataset, iter):
         save_path = os.path.join(option['eval_save_path'], self.test_epoch_num+'_epoch_{}'.format(iter), dataset)
@@ -48,89 +54,98 @@ class Tester():
             os.makedirs(save_path)
         if self.option['task'] == 'SOD' or self.option['task'] == 'Weak-RGB-SOD':
             image_root = os.path.join(self.option['paths']['test_dataset_root'], 'Imgs', dataset)
-            test_loader = test_dataset(image_root, option['testsize'])
         elif self.option['task'] == 'RGBD-SOD':
             image_root = os.path.join(self.option['paths']['test_dataset_root'], dataset, 'RGB')
-            test_loader = test_dataset_rgbd(image_root, option['testsize'])
-        
-        return {'save_path': save_path, 'test_loader': test_loader}
-
-    def forward_a_sample(self, image, HH, WW, depth=None):
-        res = self.model.forward(img=image, depth=depth)['sal_pre'][-1]
-        # Inference and get the last one of the output list
-        res = F.upsample(res, size=[WW, HH], mode='bilinear', align_corners=False)
-        res = res.sigmoid().data.cpu().numpy().squeeze()
-        res = 255*(res - res.min()) / (res.max() - res.min() + 1e-8)
-        
-        return res
-
-    def forward_a_sample_gan(self, image, HH, WW, depth=None):
-        z_noise = torch.randn(image.shape[0], self.option['latent_dim']).cuda()
-        res = self.model.forward(img=image, z=z_noise, depth=depth)['sal_pre'][-1]
+        test_loader = get_test_loader(self.option, image_root)
+        uncertainty_path = os.path.join(option['eval_save_path'], self.test_epoch_num+'_uncertainty', dataset)
+        if self.option['uncer_method'] in STOCHASTIC_METHODS and not os.path.exists(uncertainty_path):
+            os.makedirs(uncertainty_path)
+
+        return {'save_path': save_path, 'test_loader': test_loader, 'uncertainty_path': uncertainty_path}
+
+    def postprocess(self, res, sizes, logits=True):
+        # Each sample goes back to its own original (H, W) and is min-max normalized on its own
+        res_list = []
+        for pred, (h, w) in zip(res, sizes.tolist()):
+            pred = F.interpolate(pred.unsqueeze(0), size=[h, w], mode='bilinear', align_corners=False)
+            pred = pred.sigmoid() if logits else pred
+            pred = pred.data.cpu().numpy().squeeze()
+            res_list.append(255*(pred - pred.min()) / (pred.max() - pred.min() + 1e-8))
+
+        return res_list
+
+    def forward_a_sample(self, image, sizes, depth=None):
+        with torch.no_grad():
+            res = self.model.forward(img=image, depth=depth)['sal_pre'][-1]
         # Inference and get the last one of the output list
-        res = F.upsample(res, size=[WW, HH], mode='bilinear', align_corners=False)
-        res = res.sigmoid().data.cpu().numpy().squeeze()
-        res = 255*(res - res.min()) / (res.max() - res.min() + 1e-8)
-        
-        return res
-
-    def forward_a_sample_ebm(self, image, HH, WW):
-        ## Setup ebm params
-        opt = DotDict()
-        opt.ebm_out_dim = 1
-        opt.ebm_middle_dim = 100
-        opt.latent_dim = 32
-        opt.e_init_sig = 1.0
-        opt.e_l_steps = 5
-        opt.e_l_step_size = 0.4
-        opt.e_prior_sig = 1.0
-        opt.g_l_steps = 5
-        opt.g_llhd_sigma = 0.3
-        opt.g_l_step_size = 0.1
-        opt.e_energy_form = 'identity'
-        ## Setup ebm params
-        z_e_0 = sample_p_0(image, opt)
+        return self.postprocess(res, sizes)
+
+    def postprocess_samples(self, stats, sizes):
+        # The mean map is the prediction, the entropy of the mean a JET-colored uncertainty map, both with the
+        # float16 [mean, variance, entropy] maps at the original (H, W)
+        res_list, uncertainty_list, raw_list = [], [], []
+        for maps, (h, w) in zip(torch.cat([stats.mean, stats.variance, stats.entropy], 1), sizes.tolist()):
+            maps = F.interpolate(maps.unsqueeze(0), size=[h, w], mode='bilinear', align_corners=False)
+            mean, variance, entropy = maps.squeeze(0).cpu().numpy()
+            res_list.append(255*(mean - mean.min()) / (mean.max() - mean.min() + 1e-8))
+            entropy_norm = 255*(entropy - entropy.min()) / (entropy.max() - entropy.min() + 1e-8)
+            uncertainty_list.append(cv2.applyColorMap(entropy_norm.astype(np.uint8), cv2.COLORMAP_JET))
+            raw_list.append(np.stack([mean, variance, entropy]).astype(np.float16))
+
+        return res_list, uncertainty_list, raw_list
+
+    def forward_samples(self, image, sizes, depth=None):
+        # test_samples latent draws, test_sample_batch of them per backbone / neck pass, aggregated in memory
+        stats = RunningStats()
+        with torch.no_grad():
+            for start in range(0, self.option['test_samples'], self.option['test_sample_batch']):
+                K = min(self.option['test_sample_batch'], self.option['test_samples'] - start)
+                stats.update(self.model.sample(image, K, depth=depth)['samples'])
+        return self.postprocess_samples(stats, sizes)
+
+    def forward_a_sample_ebm(self, image, sizes, depth=None):
         ## sample langevin prior of z
-        z_e_0 = torch.autograd.Variable(z_e_0)
-        z = z_e_0.clone().detach()
-        z.requires_grad = True
-        for kk in range(opt.e_l_steps):
-            en = self.uncertainty_model(z)
-            z_grad = torch.autograd.grad(en.sum(), z)[0]
-            z.data = z.data - 0.5 * opt.e_l_step_size * opt.e_l_step_size * (
-                    z_grad + 1.0 / (opt.e_prior_sig * opt.e_prior_sig) * z.data)
-            z.data += opt.e_l_step_size * torch.randn_like(z).data
-
-        z_e_noise = z.detach()  ## z_
-        res = self.model.forward(img=image, z=z_e_noise)[-1]
-        res = F.upsample(res, size=[WW, HH], mode='bilinear', align_corners=False)
-        res = res.sigmoid().data.cpu().numpy().squeeze()
-        res = 255*(res - res.min()) / (res.max() - res.min() + 1e-8)
-        
-        return res
+        opt = DotDict(self.option['ebm_config'])
+        z_e_noise = self.prior_sampler(sample_p_0(image, opt), prior_energy(self.uncertainty_model))  ## z_
+        with torch.no_grad():
+            res = self.model.forward(img=image, z=z_e_noise, depth=depth)['sal_pre'][-1]
+        return self.postprocess(res, sizes)
 
     def test_one_detaset(self, dataset, iter):
         test_params = self.prepare_test_params(dataset, iter)
         test_loader, save_path = test_params['test_loader'], test_params['save_path']
+        uncertainty_list = None
 
         time_list = []
-        for i in tqdm(range(test_loader.size), desc=dataset):
-            image, depth, HH, WW, name = test_loader.load_data()  # if no rgbd sod, the depth is none 
-            image = image.cuda()
-            if depth is not None: depth = depth.cuda()
+        writer = AsyncImageWriter()
+        for pack in tqdm(test_loader, desc=dataset):
+            image, sizes, names = pack['image'].cuda(non_blocking=True), pack['size'], pack['name']
+            depth = pack['depth'].cuda(non_blocking=True) if 'depth' in pack else None  # if no rgbd sod, the depth is none
             torch.cuda.synchronize(); start = time.time()
-            if self.option['uncer_method'] == 'vae' or self.option['uncer_method'] == 'basic':
-                res = self.forward_a_sample(image, HH, WW, depth)
+            if self.option['uncer_method'] == 'basic':
+                res_list = self.forward_a_sample(image, sizes, depth)
             elif self.option['uncer_method'] == 'ebm':
-                import pdb; pdb.set_trace()
-                res = self.forward_a_sample_ebm(image, HH, WW, depth)
-            elif self.option['uncer_method'] == 'gan' or self.option['uncer_method'] == 'ganabp' or self.option['uncer_method'] == 'abp':
-                res = self.forward_a_sample_gan(image, HH, WW, depth)
+                res_list = self.forward_a_sample_ebm(image, sizes, depth)
+            elif self.option['uncer_method'] in STOCHASTIC_METHODS:
+                res_list, uncertainty_list, raw_list = self.forward_samples(image, sizes, depth)
             torch.cuda.synchronize(); end = time.time()
-            time_list.append(end-start)
-            cv2.imwrite(os.path.join(save_path, name), res)
-            
-        print('[INFO] Avg. Time used in this sequence: {:.4f}s'.format(np.mean(time_list)))
+            time_list.append((end-start) / image.shape[0])   # per image
+            for res, name in zip(res_list, names):
+                writer.write(os.path.join(save_path, name), res)
+            if uncertainty_list is not None:
+                uncertainty_path = test_params['uncertainty_path']
+                for uncertainty, raw, name in zip(uncertainty_list, raw_list, names):
+                    writer.write(os.path.join(uncertainty_path, name), uncertainty)
+                    if self.option['save_float16']:
+                        np.save(os.path.join(uncertainty_path, os.path.splitext(name)[0] + '.npy'), raw)
+        writer.close()
+
+        if self.option['uncer_method'] == 'ebm':
+            print(self.prior_sampler.summary('EBM prior'))
+            self.prior_sampler.reset_stats()
+        num_images = len(test_loader.dataset)
+        print('[INFO] Avg. Time used in this sequence: {:.4f}s model, {:.4f}s I/O wait, {:.4f}s PNG encoding '
+              '(background)'.format(np.mean(time_list), writer.wait_time / num_images, writer.encode_time / num_images))
 
 
 iters = 1
@@ -0,0 +1,57 @@
+import torch
+
+
+def make_grad_scaler(enabled):
+    if hasattr(torch.amp, 'GradScaler'):   # torch >= 2.3
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class MixedPrecision(object):
+    """Autocast + loss scaling shared by the trainers, bf16 on CPU and fp16 with a GradScaler on CUDA.
+
+    One scaler serves every optimizer of a step (generator, discriminator / ebm): backward() the losses,
+    step() each optimizer, then update() once. With param['amp'] off every call is the plain fp32 one.
+    """
+    def __init__(self, enabled, device_type):
+        self.enabled = enabled
+        self.device_type = device_type
+        self.dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+        self.scaler = make_grad_scaler(enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        # skipped when the scaled grads overflowed, update() then lowers the scale
+        self.scaler.step(optimizer)
+
+    def update(self):
+        self.scaler.update()
+
+    def unscale(self, grad):
+        """True gradient of a scaled backward for a non-parameter leaf (the Langevin z), overflows zeroed."""
+        if not self.scaler.is_enabled():
+            return grad
+        grad = grad / self.scaler.get_scale()
+        return torch.where(torch.isfinite(grad), grad, torch.zeros_like(grad))
+
+    def grad(self, loss, z):
+        """torch.autograd.grad(loss, z) through the scaler, for the Langevin updates of z."""
+        return self.unscale(torch.autograd.grad(self.scaler.scale(loss), z)[0])
+
+
+mixed_precision = None
+def get_amp(option):
+    # one instance per process, the loss scale carries over between epochs
+    global mixed_precision
+    if mixed_precision is None:
+        device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+        mixed_precision = MixedPrecision(option.get('amp', False), device_type)
+        if mixed_precision.enabled:
+            print('[INFO] Mixed precision training: {} autocast on {}, loss scaling {}'.format(
+                str(mixed_precision.dtype).split('.')[-1], device_type, mixed_precision.scaler.is_enabled()))
+    return mixed_precision
@@ -0,0 +1,215 @@
+import os
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from utils import AvgMeter, DotDict, TrainingVisualizer, normalize_image
+from trainer.amp import get_amp
+from dataset.batch_augment import DeviceAugmentLoader
+
+
+HOST_KEYS = ['index', 'size', 'name']   # bookkeeping fields of a pack, never moved to the device
+
+
+def to_device(pack, device):
+    return {k: v.to(device, non_blocking=True) if torch.is_tensor(v) and k not in HOST_KEYS else v
+            for k, v in pack.items()}
+
+
+class DevicePrefetcher(object):
+    """Moves batch n+1 to the device on a side stream while the step on batch n runs (CUDA), a plain copy otherwise.
+
+    A DeviceAugmentLoader is unwrapped: its batch augmentation runs right after the copy on the side stream, so
+    both overlap with the step instead of running in front of it on the compute stream.
+    """
+    def __init__(self, loader, device):
+        self.transform = None
+        if isinstance(loader, DeviceAugmentLoader):
+            loader, self.transform = loader.loader, loader.augment
+        self.loader = loader
+        self.device = device
+
+    def prepare(self, pack):
+        pack = to_device(pack, self.device)
+        return self.transform(pack) if self.transform is not None else pack
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for pack in self.loader:
+                yield self.prepare(pack)
+            return
+        stream = torch.cuda.Stream(self.device)
+        pending = None
+        for pack in self.loader:
+            with torch.cuda.stream(stream):
+                pack = self.prepare(pack)
+                ready = stream.record_event()
+            if pending is not None:
+                yield self.wait(*pending)
+            pending = (pack, ready)
+        if pending is not None:
+            yield self.wait(*pending)
+
+    @staticmethod
+    def wait(pack, ready):
+        current = torch.cuda.current_stream()
+        current.wait_event(ready)
+        for v in pack.values():
+            if torch.is_tensor(v) and v.is_cuda:
+                v.record_stream(current)   # the side stream allocated it, keep it alive for the compute stream
+        return pack
+
+    def __len__(self):
+        return len(self.loader)
+
+
+def unpack_batch(pack):
+    # RGB / RGB-D packs carry image, gt, (depth), index, weak packs add the scribble mask and the gray image
+    return DotDict(images=pack['image'], gts=pack['gt'], depth=pack.get('depth'), mask=pack.get('mask'),
+                   gray=pack.get('gray'), index=pack.get('index'))
+
+
+def rescale_batch(batch, rate):
+    # multi-scale training samples, the batch (H, W) is square or bucketed
+    if rate == 1:
+        return batch
+    trainsize = tuple(int(round(s*rate/32)*32) for s in batch.images.shape[-2:])
+    scaled = DotDict(batch)
+    scaled.images = F.upsample(normalize_image(batch.images), size=trainsize, mode='bilinear', align_corners=True)
+    for key in ['gts', 'depth', 'gray']:
+        if batch[key] is not None:
+            scaled[key] = F.upsample(batch[key], size=trainsize, mode='bilinear', align_corners=True)
+    if batch.mask is not None:
+        scaled.mask = F.interpolate(batch.mask, size=trainsize, mode='nearest')
+    return scaled
+
+
+class TrainStep(object):
+    """The per-method part of a training iteration, TrainingEngine runs everything around it.
+
+    __call__(engine, batch) computes the losses under engine.autocast(), hands them to engine.backward() and
+    engine.step(optimizer), and returns the three progress bar losses plus the maps to visualize.
+    """
+    model_names = ['generator', 'discriminator']
+
+    def __init__(self, option):
+        self.option = option
+
+    def begin_epoch(self, engine, epoch, dataset_size):
+        pass
+
+    def end_epoch(self, engine):
+        # e.g. report the Langevin steps used
+        pass
+
+    def save_checkpoint(self, prefix):
+        # per-method state saved next to the models, e.g. the ABP latents
+        pass
+
+    def __call__(self, engine, batch):
+        raise NotImplementedError
+
+
+class TrainingEngine(object):
+    """Shared training loop: device placement and prefetch, AMP, gradient accumulation, torch.compile,
+    loss meters / visualization and checkpoints. The uncertainty method only supplies a TrainStep."""
+    def __init__(self, option, train_step, model_list, optimizer_list, loss_fun, summary_writer=None):
+        self.option = option
+        self.train_step = train_step
+        self.models = model_list
+        self.optimizers = optimizer_list
+        self.loss_fun = loss_fun
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.amp = get_amp(option)
+        self.grad_accum = option.get('grad_accum', 1)
+        self.micro_step = 0   # within the epoch, accumulation windows start with it
+        self.global_step = 0
+        vis_config = option.get('vis_config', {})
+        # AvgMeter.show() syncs with the device, the loss postfix is refreshed on the visualization cadence
+        self.postfix_every = vis_config.get('every_steps', 100) or 100
+        self.visualizer = TrainingVisualizer(option['log_path'], vis_config.get('every_steps', 100),
+                                             vis_config.get('every_seconds', 0),
+                                             summary_writer if vis_config.get('tensorboard', False) else None)
+        if option.get('compile', False):
+            self.compile_models()
+
+    @property
+    def generator(self):
+        return self.models[0]
+
+    @property
+    def discriminator(self):
+        # the discriminator of gan / ganabp, the latent ebm of ebm
+        return self.models[1]
+
+    def compile_models(self):
+        # in place, so the state_dict keys and attribute access (generator.vae_model, ...) stay unchanged
+        if not hasattr(torch.nn.Module, 'compile'):
+            print('[INFO] nn.Module.compile needs torch >= 2.2, training eagerly')
+            return
+        for model in self.models:
+            if model is not None:
+                model.compile()
+        print('[INFO] Models compiled with torch.compile')
+
+    def autocast(self):
+        return self.amp.autocast()
+
+    def backward(self, loss):
+        self.amp.backward(loss / self.grad_accum)
+
+    def step(self, optimizer):
+        # only at the end of an accumulation window, the grads of the micro steps before it add up
+        if self.micro_step % self.grad_accum == 0:
+            self.amp.step(optimizer)
+            optimizer.zero_grad(set_to_none=True)
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            if optimizer is not None:
+                optimizer.zero_grad(set_to_none=True)
+
+    def train_one_epoch(self, epoch, train_loader, dataset_size):
+        for model in self.models:
+            if model is not None:
+                model.train()
+        # a partial window left by the previous epoch is dropped, not stepped with too few micro steps
+        self.zero_grad()
+        self.micro_step = 0
+        self.train_step.begin_epoch(self, epoch, dataset_size)
+        records = [AvgMeter(), AvgMeter(), AvgMeter()]
+        print('Learning Rate: {:.2e}'.format(self.optimizers[0].param_groups[0]['lr']))
+        progress_bar = tqdm(DevicePrefetcher(train_loader, self.device),
+                            desc='Epoch[{:03d}/{:03d}]'.format(epoch, self.option['epoch']))
+        for num_batches, pack in enumerate(progress_bar, 1):
+            batch = unpack_batch(pack)
+            for rate in self.option['size_rates']:
+                self.micro_step += 1
+                self.global_step += 1
+                losses, result_list = self.train_step(self, rescale_batch(batch, rate))
+                if self.micro_step % self.grad_accum == 0:
+                    self.amp.update()
+
+                self.visualizer(result_list, self.global_step)
+                if rate == 1:
+                    for record, loss in zip(records, losses):
+                        record.update(loss.data, self.option['batch_size'])
+
+            if num_batches % self.postfix_every == 0 or num_batches == len(progress_bar):
+                progress_bar.set_postfix(loss='|'.join('{:.3f}'.format(record.show()) for record in records))
+
+        self.train_step.end_epoch(self)
+        return records[0]
+
+    def close(self):
+        # waits for the last visualization
+        self.visualizer.close()
+
+    def save_checkpoint(self, epoch, loss_record):
+        save_path = self.option['ckpt_save_path']
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        prefix = os.path.join(save_path, '{:0>2d}_{:.3f}'.format(epoch, loss_record.show()))
+        for model_name, model in zip(self.train_step.model_names, self.models):
+            if model is not None:
+                torch.save(model.state_dict(), '{}_{}.pth'.format(prefix, model_name))
+        self.train_step.save_checkpoint(prefix)
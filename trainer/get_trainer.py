@@ -1,15 +1,18 @@
 def get_trainer(option):
+    # the per-method TrainStep, trainer.engine.TrainingEngine runs the shared loop around it
     if option['uncer_method'].lower() == 'gan':
-        from trainer.trainer_gan import train_one_epoch
+        from trainer.trainer_gan import GanStep as TrainStep
     elif option['uncer_method'].lower() == 'vae':
-        from trainer.trainer_vae import train_one_epoch
+        from trainer.trainer_vae import VaeStep as TrainStep
     elif option['uncer_method'].lower() == 'abp':
-        from trainer.trainer_abp import train_one_epoch
+        from trainer.trainer_abp import AbpStep as TrainStep
     elif option['uncer_method'].lower() == 'ebm':
-        from trainer.trainer_ebm import train_one_epoch
+        from trainer.trainer_ebm import EbmStep as TrainStep
     elif option['uncer_method'].lower() == 'basic':
-        from trainer.trainer_basic import train_one_epoch
+        from trainer.trainer_basic import BasicStep as TrainStep
     elif option['uncer_method'].lower() == 'ganabp':
-        from trainer.trainer_ganabp import train_one_epoch
+        from trainer.trainer_ganabp import GanAbpStep as TrainStep
+    else:
+        raise NotImplementedError
 
-    return train_one_epoch
+    return TrainStep(option)
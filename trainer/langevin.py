@@ -0,0 +1,96 @@
+import contextlib
+import torch
+
+
+def detach_features(features):
+    if torch.is_tensor(features):
+        return features.detach()
+    if isinstance(features, (list, tuple)):
+        return [detach_features(f) for f in features]
+    if isinstance(features, dict):
+        return {k: detach_features(v) for k, v in features.items()}
+    return features
+
+
+def select_samples(features, active):
+    # the still running chains of an encode() feature dict, the backbone features are not decoded from
+    if features is None:
+        return None
+    if isinstance(features, (list, tuple)):
+        return [select_samples(f, active) for f in features]
+    if isinstance(features, dict):
+        return dict(features, neck_features=select_samples(features['neck_features'], active),
+                    depth_features=select_samples(features['depth_features'], active))
+    return features[active]
+
+
+class LangevinSampler(object):
+    """Langevin dynamics z <- z - s^2/2 * (dE/dz + z / prior_sig^2) + s * noise, with per-sample early stopping.
+
+    energy(z, active) returns the (len(active),) energies of the running chains, `active` indexes them in the
+    batch. After min_steps a chain stops once its relative energy change falls below energy_tol or its gradient
+    norm below grad_tol (0 disables either) and leaves the batch, so the energy is evaluated on fewer samples.
+    No chain runs more than step_num steps, nor more than the max_steps budget of param['langevin'].
+    """
+    def __init__(self, step_num, step_size, prior_sig=None, config=None):
+        config = config or {}
+        self.max_steps = config.get('max_steps', None)
+        self.step_num = self.clip_steps(step_num)
+        self.step_size = step_size
+        self.prior_sig = prior_sig
+        self.min_steps = config.get('min_steps', 1)
+        self.energy_tol = config.get('energy_tol', 0)
+        self.grad_tol = config.get('grad_tol', 0)
+        self.reset_stats()
+
+    def clip_steps(self, step_num):
+        return step_num if self.max_steps is None else min(step_num, self.max_steps)
+
+    def reset_stats(self):
+        self.batches, self.chains, self.chain_steps = 0, 0, 0
+
+    def stats(self):
+        # average Langevin steps per sample, energy evaluations per batch
+        return self.chain_steps / max(self.chains, 1), self.chain_steps / max(self.batches, 1)
+
+    def summary(self, name):
+        steps, evaluations = self.stats()
+        return '[INFO] {} Langevin: {:.2f} / {} steps per sample, {:.1f} sample evaluations per batch'.format(
+            name, steps, self.step_num, evaluations)
+
+    def __call__(self, z, energy, amp=None, step_num=None):
+        step_num = self.step_num if step_num is None else self.clip_steps(step_num)
+        early_stop = self.energy_tol > 0 or self.grad_tol > 0
+        z = z.detach().clone()
+        active = torch.arange(z.shape[0], device=z.device)
+        last_energy = None
+        self.batches += 1
+        self.chains += z.shape[0]
+        for kk in range(step_num):
+            z_active = z[active].requires_grad_()
+            with amp.autocast() if amp is not None else contextlib.nullcontext():
+                en = energy(z_active, active).float()
+            grad = amp.grad(en.sum(), z_active) if amp is not None else torch.autograd.grad(en.sum(), z_active)[0]
+            z_active = z_active.detach()
+            if self.prior_sig is not None:
+                grad = grad + z_active / (self.prior_sig * self.prior_sig)
+            z_active = z_active - 0.5 * self.step_size * self.step_size * grad + self.step_size * torch.randn_like(z_active)
+            z[active] = z_active
+            self.chain_steps += active.numel()
+
+            if not early_stop or kk + 1 == step_num:
+                continue
+            en = en.detach()
+            done = torch.zeros_like(en, dtype=torch.bool)
+            if kk + 1 >= self.min_steps:
+                if self.grad_tol > 0:
+                    done |= grad.flatten(1).norm(dim=1) < self.grad_tol
+                if self.energy_tol > 0 and last_energy is not None:
+                    done |= (en - last_energy).abs() <= self.energy_tol * last_energy.abs().clamp(min=1e-8)
+            keep = ~done
+            if not bool(keep.all()):   # host sync, only with early stopping on
+                active, en = active[keep], en[keep]
+                if active.numel() == 0:
+                    break
+            last_energy = en
+        return z
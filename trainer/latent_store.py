@@ -0,0 +1,65 @@
+import os
+import shutil
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+
+class LatentStore(object):
+    """Per-sample ABP posterior latents, a float32 (dataset_size, latent_dim) memmap indexed by the pack 'index'.
+
+    The Langevin chain of a sample continues from where its last visit left it, across epochs and, through
+    the checkpoint copies, across runs. `visits` counts the epochs in which a sample was updated, once per
+    epoch however many size_rates update it. A batch is warm when all its latents come from an earlier
+    epoch, the ABP step can run fewer Langevin steps on it.
+    """
+    def __init__(self, path, dataset_size, latent_dim, resume=None, seed=0):
+        self.path = path
+        self.visits_path = path.replace('.npy', '_visits.npy')
+        if resume is not None:
+            shutil.copyfile(resume, self.path)
+            shutil.copyfile(resume.replace('.npy', '_visits.npy'), self.visits_path)
+            print('[INFO] Resume the ABP latents from {}'.format(resume))
+        else:
+            self.initialize(dataset_size, latent_dim, seed)
+        self.z = open_memmap(self.path, mode='r+')
+        self.visits = open_memmap(self.visits_path, mode='r+')
+        if self.z.shape != (dataset_size, latent_dim):
+            raise ValueError('Latent store {} holds {}, expected {}'.format(self.path, self.z.shape, (dataset_size, latent_dim)))
+        self.updated = np.zeros(dataset_size, dtype=bool)   # updated in the current epoch
+
+    def begin_epoch(self):
+        self.updated[:] = False
+
+    def initialize(self, dataset_size, latent_dim, seed, chunk=65536):
+        z = open_memmap(self.path, mode='w+', dtype=np.float32, shape=(dataset_size, latent_dim))
+        rng = np.random.default_rng(seed)
+        for start in range(0, dataset_size, chunk):
+            z[start:start+chunk] = rng.standard_normal((min(chunk, dataset_size - start), latent_dim), dtype=np.float32)
+        z.flush()
+        open_memmap(self.visits_path, mode='w+', dtype=np.int32, shape=(dataset_size,)).flush()
+
+    def get(self, index, device):
+        index = np.asarray(index)
+        earlier = self.visits[index] - self.updated[index]   # the visits of earlier epochs
+        return torch.from_numpy(self.z[index]).to(device), bool(earlier.min() > 0)
+
+    def put(self, index, z):
+        index = np.asarray(index)
+        self.z[index] = z.detach().float().cpu().numpy()
+        self.visits[index[~self.updated[index]]] += 1
+        self.updated[index] = True
+
+    def save(self, path):
+        self.z.flush()
+        self.visits.flush()
+        shutil.copyfile(self.path, path)
+        shutil.copyfile(self.visits_path, path.replace('.npy', '_visits.npy'))
+
+
+def latent_checkpoint(checkpoint):
+    # 50_0.123_generator.pth -> 50_0.123_latents.npy, saved next to it by TrainingEngine.save_checkpoint
+    if checkpoint is None:
+        return None
+    path = checkpoint.replace('_generator.pth', '_latents.npy')
+    return path if path != checkpoint and os.path.exists(path) else None
@@ -1,100 +1,88 @@
 import os
-import pdb
-import cv2
-import time
 import torch
-import torch.nn.functional as F
-from torch.autograd import Variable
-from tqdm import tqdm
-from config import param as option
-from utils import AvgMeter, label_edge_prediction, visualize_list
-from loss.get_loss import cal_loss
 from utils import DotDict
-from loss.StructureConsistency import SaliencyStructureConsistency as SSIMLoss
+from trainer.engine import TrainStep
+from trainer.langevin import LangevinSampler, detach_features, select_samples
+from trainer.latent_store import LatentStore, latent_checkpoint
+from trainer.trainer_gan import supervised_loss_of
 
 
-CE = torch.nn.BCELoss()
-def train_one_epoch(epoch, model_list, optimizer_list, train_loader, dataset_size, loss_fun):
-    ## Setup abp params
+def abp_config(config):
     opt = DotDict()
-    opt.latent_dim = option['abp_config']['latent_dim']
-    opt.langevin_step_num_gen = option['abp_config']['step_num']
-    opt.sigma_gen = option['abp_config']['sigma_gen']
-    opt.langevin_s = option['abp_config']['langevin_s']
-    train_z = torch.FloatTensor(dataset_size, opt.latent_dim).normal_(0, 1).cuda()
-    ## Setup abp params
-
-    generator, discriminator = model_list
-    generator_optimizer, discriminator_optimizer = optimizer_list
-    generator.train()
-    if discriminator is not None:
-        discriminator.train()
-    loss_record, supervised_loss_record, dis_loss_record = AvgMeter(), AvgMeter(), AvgMeter()
-    print('Learning Rate: {:.2e}'.format(generator_optimizer.param_groups[0]['lr']))
-    progress_bar = tqdm(train_loader, desc='Epoch[{:03d}/{:03d}]'.format(epoch, option['epoch']))
-    for i, pack in enumerate(progress_bar):
-        for rate in option['size_rates']:
-            generator_optimizer.zero_grad()
-            if discriminator is not None:
-                discriminator_optimizer.zero_grad()
-            if len(pack) == 3:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), None, pack['index']
-            elif len(pack) == 4:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), pack['depth'].cuda(), pack['index']
-            elif len(pack) == 5:
-                images, gts, mask, gray, index, depth = pack['image'].cuda(), pack['gt'].cuda(), pack['mask'].cuda(), pack['gray'].cuda(), pack['index'], None
-
-            # multi-scale training samples
-            trainsize = (int(round(option['trainsize'] * rate / 32) * 32), int(round(option['trainsize'] * rate / 32) * 32))
-            if rate != 1:
-                images = F.upsample(images, size=trainsize, mode='bilinear', align_corners=True)
-                gts = F.upsample(gts, size=trainsize, mode='bilinear', align_corners=True)
-
-            z_noise = train_z[index]
-            z_noise = Variable(z_noise, requires_grad=True)
-            z_noise_preds = [z_noise.clone() for _ in range(opt.langevin_step_num_gen + 1)]
-            for kk in range(opt.langevin_step_num_gen):
-                z_noise = Variable(z_noise_preds[kk], requires_grad=True).cuda()
-                noise = torch.randn(z_noise.size()).cuda()
-
-                gen_res = generator(img=images, z=z_noise, depth=depth)['sal_pre']
-                gen_loss = 0
-                for i in gen_res:
-                    if option['task'].lower() == 'weak-rgb-sod':
-                        gen_loss += 1 / (2.0 * opt.sigma_gen * opt.sigma_gen) * F.mse_loss(torch.sigmoid(i)*mask, gts*mask, size_average=True, reduction='sum')
-                    else:
-                        gen_loss += 1 / (2.0 * opt.sigma_gen * opt.sigma_gen) * F.mse_loss(torch.sigmoid(i), gts, size_average=True, reduction='sum')
-                gen_loss.backward(torch.ones(gen_loss.size()).cuda())
-
-                grad = z_noise.grad
-                z_noise = z_noise + 0.5 * opt.langevin_s * opt.langevin_s * grad
-                z_noise += opt.langevin_s * noise
-                z_noise_preds[kk + 1] = z_noise
-
-            z_noise_ref = z_noise
-            
-            pred = generator(img=images, z=z_noise_ref, depth=depth)
-            sal_pred = pred['sal_pre']
-
-            ## Caltulate loss
-            # loss_init, loss_ref = cal_loss(pred_init, gts, loss_fun), cal_loss(pred_ref, gts, loss_fun)
-            if option['task'].lower() == 'sod':
-                supervised_loss = cal_loss(sal_pred, gts, loss_fun)
-            elif option['task'].lower() == 'weak-rgb-sod':
-                supervised_loss = loss_fun(images=images, outputs=sal_pred, gt=gts, masks=mask, grays=gray, model=generator)
-
-            supervised_loss.backward()
-            generator_optimizer.step()
-
-            result_list = [torch.sigmoid(x) for x in sal_pred]
-            result_list.append(gts)
-            visualize_list(result_list, option['log_path'])
-
-            if rate == 1:
-                loss_record.update(supervised_loss.data, option['batch_size'])
-                supervised_loss_record.update(supervised_loss.data, option['batch_size'])
-                dis_loss_record.update(supervised_loss.data, option['batch_size'])
-
-        progress_bar.set_postfix(loss=f'{loss_record.show():.3f}|{supervised_loss_record.show():.3f}|{dis_loss_record.show():.3f}')
-
-    return {'generator': generator, "discriminator": discriminator}, loss_record
+    opt.latent_dim = config['latent_dim']
+    opt.langevin_step_num_gen = config['step_num']
+    opt.sigma_gen = config['sigma_gen']
+    opt.langevin_s = config['langevin_s']
+    return opt
+
+
+def abp_sampler(option, config):
+    return LangevinSampler(config['step_num'], config['langevin_s'], config=option.get('langevin'))
+
+
+def langevin_posterior(engine, batch, features, z_noise, opt, sampler, step_num=None):
+    # Langevin dynamics on z towards the posterior of the generator likelihood of the gts. Only noise_model and
+    # the decoder depend on z, they run on the detached encode() features and only z gets a gradient.
+    generator = engine.generator
+    features = detach_features(features)
+    batch_size = z_noise.shape[0]
+
+    def energy(z, active):
+        full = active.numel() == batch_size
+        gen_res = generator.decode(features if full else select_samples(features, active), z)['sal_pre']
+        gts = batch.gts if full else batch.gts[active]
+        mask = batch.mask if full or batch.mask is None else batch.mask[active]
+        gen_loss = 0
+        for i in gen_res:
+            pred, target = torch.sigmoid(i).float(), gts
+            if mask is not None:   # weak-rgb-sod
+                pred, target = pred * mask, gts * mask
+            gen_loss += 1 / (2.0 * opt.sigma_gen * opt.sigma_gen) * (pred - target).pow(2).flatten(1).mean(1)
+        # per-sample terms of the batch mean mse, negated: the ABP update is z + s^2/2 * d(gen_loss)/dz
+        return -gen_loss / batch_size
+    return sampler(z_noise, energy, amp=engine.amp, step_num=step_num)
+
+
+class AbpStep(TrainStep):
+    def __init__(self, option):
+        super(AbpStep, self).__init__(option)
+        self.opt = abp_config(option['abp_config'])
+        self.warm_step_num = option['abp_config'].get('warm_step_num', self.opt.langevin_step_num_gen)
+        self.sampler = abp_sampler(option, option['abp_config'])
+        self.latent_store = None
+
+    def begin_epoch(self, engine, epoch, dataset_size):
+        if self.latent_store is None:
+            if not os.path.exists(self.option['log_path']):
+                os.makedirs(self.option['log_path'])
+            self.latent_store = LatentStore(os.path.join(self.option['log_path'], 'abp_latents.npy'), dataset_size,
+                                            self.opt.latent_dim, resume=latent_checkpoint(self.option['checkpoint']),
+                                            seed=self.option.get('seed', 0))
+        self.latent_store.begin_epoch()
+
+    def __call__(self, engine, batch):
+        # backbone + neck once per step, shared by the Langevin updates and the supervised loss
+        with engine.autocast():
+            features = engine.generator.encode(batch.images, batch.depth)
+        z_noise, warm = self.latent_store.get(batch.index, engine.device)
+        z_noise = langevin_posterior(engine, batch, features, z_noise, self.opt, self.sampler,
+                                     self.warm_step_num if warm else self.opt.langevin_step_num_gen)
+        self.latent_store.put(batch.index, z_noise)
+
+        with engine.autocast():
+            sal_pred = engine.generator.decode(features, z_noise)['sal_pre']
+            supervised_loss = supervised_loss_of(engine, batch, sal_pred)
+
+        engine.backward(supervised_loss)
+        engine.step(engine.optimizers[0])
+
+        result_list = [torch.sigmoid(x) for x in sal_pred]
+        result_list.append(batch.gts)
+        return [supervised_loss, supervised_loss, supervised_loss], result_list
+
+    def end_epoch(self, engine):
+        print(self.sampler.summary('ABP posterior'))
+        self.sampler.reset_stats()
+
+    def save_checkpoint(self, prefix):
+        self.latent_store.save(prefix + '_latents.npy')
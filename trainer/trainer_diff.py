@@ -6,7 +6,7 @@ import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 from config import param as option
-from utils import AvgMeter, label_edge_prediction, visualize_list
+from utils import AvgMeter, label_edge_prediction, visualize_list, normalize_image
 from loss.get_loss import cal_loss
 
 
@@ -33,9 +33,9 @@ def train_one_epoch(epoch, model_list, optimizer_list, train_loader, dataset_siz
             #     images, gts, mask, gray = pack['image'].cuda(), pack['gt'].cuda(), pack['mask'].cuda(), pack['gray'].cuda()
 
             # multi-scale training samples
-            trainsize = (int(round(option['trainsize'] * rate / 32) * 32), int(round(option['trainsize'] * rate / 32) * 32))
+            trainsize = tuple(int(round(s*rate/32)*32) for s in images.shape[-2:])   # the batch (H, W), square or bucketed
             if rate != 1:
-                images = F.upsample(images, size=trainsize, mode='bilinear', align_corners=True)
+                images = F.upsample(normalize_image(images), size=trainsize, mode='bilinear', align_corners=True)
                 gts = F.upsample(gts, size=trainsize, mode='bilinear', align_corners=True)
             # Inference Once
             ref_pre = generator(images, depth)
@@ -47,7 +47,7 @@ def train_one_epoch(epoch, model_list, optimizer_list, train_loader, dataset_siz
             if discriminator is not None:
                 for pre in ref_pre:
                     dis_pred = pre.detach()
-                    output = torch.cat((images, dis_pred), 1)
+                    output = torch.cat((normalize_image(images), dis_pred), 1)
                     Dis_output = discriminator(output)
                     Dis_output = F.upsample(Dis_output, size=trainsize, mode='bilinear', align_corners=True)
                     Dis_output_list.append(Dis_output.detach())
@@ -1,114 +1,75 @@
-import os
-import pdb
-import cv2
-import time
 import torch
-import torch.nn.functional as F
-from torch.autograd import Variable
-from tqdm import tqdm
-from config import param as option
-from utils import AvgMeter, visualize_list, make_dis_label, sample_p_0, compute_energy
+from utils import sample_p_0, compute_energy, DotDict
 from loss.get_loss import cal_loss
-from utils import DotDict
-
-
-CE = torch.nn.BCELoss()
-def train_one_epoch(epoch, model_list, optimizer_list, train_loader, dataset_size, loss_fun):
-    ## Setup ebm params
-    opt = DotDict()
-    opt.ebm_out_dim = 1
-    opt.ebm_middle_dim = 100
-    opt.latent_dim = 32
-    opt.e_init_sig = 1.0
-    opt.e_l_steps = 5
-    opt.e_l_step_size = 0.4
-    opt.e_prior_sig = 1.0
-    opt.g_l_steps = 5
-    opt.g_llhd_sigma = 0.3
-    opt.g_l_step_size = 0.1
-    opt.e_energy_form = 'identity'
-    ## Setup ebm params
-
-    generator, ebm_model = model_list
-    generator_optimizer, ebm_model_optimizer = optimizer_list
-    generator.train()
-    if ebm_model is not None:
-        ebm_model.train()
-    loss_record, supervised_loss_record, dis_loss_record = AvgMeter(), AvgMeter(), AvgMeter()
-    print('Learning Rate: {:.2e}'.format(generator_optimizer.param_groups[0]['lr']))
-    progress_bar = tqdm(train_loader, desc='Epoch[{:03d}/{:03d}]'.format(epoch, option['epoch']))
-    for i, pack in enumerate(progress_bar):
-        for rate in option['size_rates']:
-            generator_optimizer.zero_grad()
-            if ebm_model is not None:
-                ebm_model_optimizer.zero_grad()
-            if len(pack) == 3:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), None, pack['index']
-            elif len(pack) == 4:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), pack['depth'].cuda(), pack['index']
-            # elif len(pack) == 4:
-            #     images, gts, mask, gray = pack['image'].cuda(), pack['gt'].cuda(), pack['mask'].cuda(), pack['gray'].cuda()
-
-            # multi-scale training samples
-            trainsize = (int(round(option['trainsize']*rate/32)*32), int(round(option['trainsize']*rate/32)*32))
-            if rate != 1:
-                images = F.upsample(images, size=trainsize, mode='bilinear', align_corners=True)
-                gts = F.upsample(gts, size=trainsize, mode='bilinear', align_corners=True)
-
-            z_e_0 = sample_p_0(images, opt)
-            z_g_0 = sample_p_0(images, opt)
-
-            z_e_0 = Variable(z_e_0)
-            z = z_e_0.clone().detach()
-            z.requires_grad = True
-            for kk in range(opt.e_l_steps):
-                en = ebm_model(z)
-                z_grad = torch.autograd.grad(en.sum(), z)[0]
-                z.data = z.data - 0.5 * opt.e_l_step_size * opt.e_l_step_size * (
-                        z_grad + 1.0 / (opt.e_prior_sig * opt.e_prior_sig) * z.data)
-                z.data += opt.e_l_step_size * torch.randn_like(z).data
-            z_e_noise = z.detach()  ## z_
-
-            z_g_0 = Variable(z_g_0)
-            z = z_g_0.clone().detach()
-            z.requires_grad = True
-            for kk in range(opt.g_l_steps):
-                gen_res = generator(images, z)
-                g_log_lkhd = 1.0 / (2.0 * opt.g_llhd_sigma * opt.g_llhd_sigma) * F.mse_loss(
-                    torch.sigmoid(gen_res[0]), gts)
-                z_grad_g = torch.autograd.grad(g_log_lkhd, z)[0]
-
-                en = ebm_model(z)
-                z_grad_e = torch.autograd.grad(en.sum(), z)[0]
-
-                z.data = z.data - 0.5 * opt.g_l_step_size * opt.g_l_step_size * (
-                        z_grad_g + z_grad_e + 1.0 / (opt.e_prior_sig * opt.e_prior_sig) * z.data)
-                z.data += opt.g_l_step_size * torch.randn_like(z).data
-
-            z_g_noise = z.detach()  ## z+
-
-            pred = generator(img=images, z=z_g_noise, depth=depth)
-            loss_all = cal_loss(pred, gts, loss_fun)
-
-            loss_all.backward()
-            generator_optimizer.step()
-
-            ## learn the ebm
-            en_neg = compute_energy(option=opt, score=ebm_model(z_e_noise.detach())).mean()
-            en_pos = compute_energy(option=opt, score=ebm_model(z_g_noise.detach())).mean()
+from trainer.engine import TrainStep
+from trainer.langevin import LangevinSampler, detach_features, select_samples
+
+
+def prior_energy(ebm_model):
+    def energy(z, active):
+        return ebm_model(z).flatten(1).sum(1)
+    return energy
+
+
+def ebm_samplers(option):
+    opt = option['ebm_config']
+    return (LangevinSampler(opt['e_l_steps'], opt['e_l_step_size'], opt['e_prior_sig'], option.get('langevin')),
+            LangevinSampler(opt['g_l_steps'], opt['g_l_step_size'], opt['e_prior_sig'], option.get('langevin')))
+
+
+class EbmStep(TrainStep):
+    model_names = ['generator', 'ebm_model']
+
+    def __init__(self, option):
+        super(EbmStep, self).__init__(option)
+        self.opt = DotDict(option['ebm_config'])
+        self.prior_sampler, self.posterior_sampler = ebm_samplers(option)
+
+    def end_epoch(self, engine):
+        print(self.prior_sampler.summary('EBM prior'))
+        print(self.posterior_sampler.summary('EBM posterior'))
+        self.prior_sampler.reset_stats()
+        self.posterior_sampler.reset_stats()
+
+    def __call__(self, engine, batch):
+        opt, amp = self.opt, engine.amp
+        generator, ebm_model = engine.generator, engine.discriminator
+        generator_optimizer, ebm_model_optimizer = engine.optimizers
+
+        ## sample langevin prior of z
+        z_e_noise = self.prior_sampler(sample_p_0(batch.images, opt), prior_energy(ebm_model), amp=amp)  ## z_
+
+        ## sample langevin posterior of z, the decoder runs on the detached encode() features
+        with engine.autocast():
+            features = generator.encode(batch.images, batch.depth)
+        detached = detach_features(features)
+        batch_size = batch.images.shape[0]
+
+        def posterior_energy(z, active):
+            full = active.numel() == batch_size
+            gen_res = generator.decode(detached if full else select_samples(detached, active), z)['sal_pre']
+            gts = batch.gts if full else batch.gts[active]
+            # per-sample terms of the batch mean mse
+            g_log_lkhd = 1.0 / (2.0 * opt.g_llhd_sigma * opt.g_llhd_sigma) * (
+                torch.sigmoid(gen_res[0]).float() - gts).pow(2).flatten(1).mean(1) / batch_size
+            return g_log_lkhd + ebm_model(z).flatten(1).sum(1)
+        z_g_noise = self.posterior_sampler(sample_p_0(batch.images, opt), posterior_energy, amp=amp)  ## z+
+
+        with engine.autocast():
+            sal_pred = generator.decode(features, z_g_noise)['sal_pre']
+            loss_all = cal_loss(sal_pred, batch.gts, engine.loss_fun)
+
+        engine.backward(loss_all)
+        engine.step(generator_optimizer)
+
+        ## learn the ebm
+        with engine.autocast():
+            en_neg = compute_energy(option=opt, score=ebm_model(z_e_noise)).mean()
+            en_pos = compute_energy(option=opt, score=ebm_model(z_g_noise)).mean()
             loss_e = en_pos - en_neg
-            loss_e.backward()
-            ebm_model_optimizer.step()
+        engine.backward(loss_e)
+        engine.step(ebm_model_optimizer)
 
-            result_list = [torch.sigmoid(x) for x in pred]
-            result_list.append(gts)
-            visualize_list(result_list, option['log_path'])
-
-            if rate == 1:
-                loss_record.update(loss_all.data, option['batch_size'])
-                supervised_loss_record.update(en_pos.data, option['batch_size'])
-                dis_loss_record.update(en_neg.data, option['batch_size'])
-
-        progress_bar.set_postfix(loss=f'{loss_record.show():.3f}|{supervised_loss_record.show():.3f}|{dis_loss_record.show():.3f}')
-
-    return {'generator': generator, "ebm_model": ebm_model}, loss_record
+        result_list = [torch.sigmoid(x) for x in sal_pred]
+        result_list.append(batch.gts)
+        return [loss_all, en_pos, en_neg], result_list
@@ -1,102 +1,67 @@
-import os
-import pdb
-import cv2
-import time
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
-from tqdm import tqdm
-from config import param as option
-from utils import AvgMeter, label_edge_prediction, visualize_list, make_dis_label
+from utils import make_dis_label, normalize_image, float32_forward
 from loss.get_loss import cal_loss
-from utils import DotDict
-from loss.StructureConsistency import SaliencyStructureConsistency as SSIMLoss
+from trainer.engine import TrainStep
 
 
-CE = torch.nn.BCELoss()
-def train_one_epoch(epoch, model_list, optimizer_list, train_loader, dataset_size, loss_fun):
-    ## Setup gan params
-    opt = DotDict()
-    opt.latent_dim = option['gan_config']['latent_dim']
-    opt.pred_label = option['gan_config']['pred_label']
-    opt.gt_label = option['gan_config']['gt_label']
-    ## Setup gan params
+CE = float32_forward(torch.nn.BCELoss())
 
-    generator, discriminator = model_list
-    generator_optimizer, discriminator_optimizer = optimizer_list
-    generator.train()
-    if discriminator is not None:
-        discriminator.train()
-    loss_record, supervised_loss_record, dis_loss_record = AvgMeter(), AvgMeter(), AvgMeter()
-    print('Learning Rate: {:.2e}'.format(generator_optimizer.param_groups[0]['lr']))
-    progress_bar = tqdm(train_loader, desc='Epoch[{:03d}/{:03d}]'.format(epoch, option['epoch']))
-    for i, pack in enumerate(progress_bar):
-        for rate in option['size_rates']:
-            generator_optimizer.zero_grad()
-            if discriminator is not None:
-                discriminator_optimizer.zero_grad()
-            if len(pack) == 3:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), None, pack['index']
-            elif len(pack) == 4:
-                images, gts, depth, index = pack['image'].cuda(), pack['gt'].cuda(), pack['depth'].cuda(), pack['index']
-            elif len(pack) == 5:
-                images, gts, mask, gray, depth = pack['image'].cuda(), pack['gt'].cuda(), pack['mask'].cuda(), pack['gray'].cuda(), None
 
-            # multi-scale training samples
-            trainsize = (int(round(option['trainsize']*rate/32)*32), int(round(option['trainsize']*rate/32)*32))
-            if rate != 1:
-                images = F.upsample(images, size=trainsize, mode='bilinear', align_corners=True)
-                gts = F.upsample(gts, size=trainsize, mode='bilinear', align_corners=True)
+def discriminate(discriminator, batch, pred):
+    # the discriminator sees the image with a (scribble-masked, for weak supervision) saliency map
+    if batch.mask is not None:
+        pred = batch.mask * pred
+    return discriminator(torch.cat((normalize_image(batch.images), pred), 1))
 
-            z_noise = torch.randn(images.shape[0], opt.latent_dim).cuda()
-            pred = generator(img=images, z=z_noise, depth=depth)
-            sal_pred = pred['sal_pre']
-            if option['task'].lower() == 'sod':
-                Dis_output = discriminator(torch.cat((images, torch.sigmoid(sal_pred[0]).detach()), 1))
-            elif option['task'].lower() == 'weak-rgb-sod':
-                Dis_output = discriminator(torch.cat((images, mask*torch.sigmoid(sal_pred[0]).detach()), 1))
 
-            up_size = (images.shape[2], images.shape[3])
-            Dis_output = F.upsample(Dis_output, size=up_size, mode='bilinear', align_corners=True)
-            
-            loss_dis_output = CE(torch.sigmoid(Dis_output), make_dis_label(opt.gt_label, gts))
-            
-            if option['task'].lower() == 'sod':
-                import pdb; pdb.set_trace()
-                supervised_loss = cal_loss(pred['sal_pre'], gts, loss_fun)
-            elif option['task'].lower() == 'weak-rgb-sod':
-                supervised_loss = loss_fun(images=images, outputs=pred['sal_pre'], gt=gts, masks=mask, grays=gray, model=generator)
+def discriminator_loss(engine, batch, pred, pred_label, gt_label):
+    # pred (detached) is the fake, the ground truth the real sample
+    up_size = batch.images.shape[-2:]
+    Dis_output = discriminate(engine.discriminator, batch, pred)
+    Dis_target = engine.discriminator(torch.cat((normalize_image(batch.images), batch.gts), 1))
+    Dis_output = F.upsample(torch.sigmoid(Dis_output), size=up_size, mode='bilinear', align_corners=True)
+    Dis_target = F.upsample(torch.sigmoid(Dis_target), size=up_size, mode='bilinear', align_corners=True)
+
+    loss_dis_output = CE(torch.sigmoid(Dis_output), make_dis_label(pred_label, batch.gts))
+    loss_dis_target = CE(torch.sigmoid(Dis_target), make_dis_label(gt_label, batch.gts))
+    return 0.5 * (loss_dis_output + loss_dis_target), Dis_output, Dis_target
 
-            loss_all = supervised_loss + 0.1*loss_dis_output
 
-            loss_all.backward()
-            generator_optimizer.step()
+def supervised_loss_of(engine, batch, sal_pred):
+    if batch.mask is not None:   # weak-rgb-sod
+        return engine.loss_fun(images=normalize_image(batch.images), outputs=sal_pred, gt=batch.gts,
+                               masks=batch.mask, grays=batch.gray, model=engine.generator)
+    return cal_loss(sal_pred, batch.gts, engine.loss_fun)
 
-            # train discriminator
-            dis_pred = torch.sigmoid(sal_pred[0]).detach()
-            if option['task'].lower() == 'sod':
-                Dis_output = discriminator(torch.cat((images, dis_pred), 1))
-            elif option['task'].lower() == 'weak-rgb-sod':
-                Dis_output = discriminator(torch.cat((images, mask*dis_pred), 1))
-            Dis_target = discriminator(torch.cat((images, gts), 1))
-            Dis_output = F.upsample(torch.sigmoid(Dis_output), size=up_size, mode='bilinear', align_corners=True)
-            Dis_target = F.upsample(torch.sigmoid(Dis_target), size=up_size, mode='bilinear', align_corners=True)
 
-            loss_dis_output = CE(torch.sigmoid(Dis_output), make_dis_label(opt.pred_label, gts))
-            loss_dis_target = CE(torch.sigmoid(Dis_target), make_dis_label(opt.gt_label, gts))
-            dis_loss = 0.5 * (loss_dis_output + loss_dis_target)
-            dis_loss.backward()
-            discriminator_optimizer.step()
+class GanStep(TrainStep):
+    def __init__(self, option):
+        super(GanStep, self).__init__(option)
+        self.latent_dim = option['gan_config']['latent_dim']
+        self.pred_label = option['gan_config']['pred_label']
+        self.gt_label = option['gan_config']['gt_label']
 
-            result_list = [torch.sigmoid(x) for x in sal_pred]
-            result_list.append(gts)
-            visualize_list(result_list, option['log_path'])
+    def __call__(self, engine, batch):
+        generator_optimizer, discriminator_optimizer = engine.optimizers
+        z_noise = torch.randn(batch.images.shape[0], self.latent_dim, device=batch.images.device)
+        with engine.autocast():
+            sal_pred = engine.generator(img=batch.images, z=z_noise, depth=batch.depth)['sal_pre']
+            Dis_output = discriminate(engine.discriminator, batch, torch.sigmoid(sal_pred[0]).detach())
+            Dis_output = F.upsample(Dis_output, size=batch.images.shape[-2:], mode='bilinear', align_corners=True)
+            loss_dis_output = CE(torch.sigmoid(Dis_output), make_dis_label(self.gt_label, batch.gts))
+            supervised_loss = supervised_loss_of(engine, batch, sal_pred)
+            loss_all = supervised_loss + 0.1*loss_dis_output
 
-            if rate == 1:
-                loss_record.update(supervised_loss.data, option['batch_size'])
-                supervised_loss_record.update((loss_all-supervised_loss).data, option['batch_size'])
-                dis_loss_record.update(dis_loss.data, option['batch_size'])
+        engine.backward(loss_all)
+        engine.step(generator_optimizer)
 
-        progress_bar.set_postfix(loss=f'{loss_record.show():.3f}|{supervised_loss_record.show():.3f}|{dis_loss_record.show():.3f}')
+        # train discriminator
+        with engine.autocast():
+            dis_loss, _, _ = discriminator_loss(engine, batch, torch.sigmoid(sal_pred[0]).detach(), self.pred_label, self.gt_label)
+        engine.backward(dis_loss)
+        engine.step(discriminator_optimizer)
 
-    return {'generator': generator, "discriminator": discriminator}, loss_record
+        result_list = [torch.sigmoid(x) for x in sal_pred]
+        result_list.append(batch.gts)
+        return [supervised_loss, loss_all-supervised_loss, dis_loss], result_list
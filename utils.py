@@ -7,6 +7,58 @@ from torch.autograd import Variable
 import torch
 import numpy as np
 import random
+import time
+import queue
+import threading
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+
+
+def normalize_image(image):
+    # uint8 [0, 255] images -> ImageNet-normalized floats, float images are already normalized
+    if image.dtype != torch.uint8:
+        return image
+    mean = torch.tensor(IMAGE_MEAN, device=image.device).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGE_STD, device=image.device).view(1, 3, 1, 1)
+    return (image.float() / 255 - mean) / std
+
+
+def autocast_devices():
+    # device types with an active autocast region
+    try:
+        return [d for d in ['cuda', 'cpu'] if torch.is_autocast_enabled(d)]
+    except TypeError:   # torch < 2.4
+        return [d for d, on in [('cuda', torch.is_autocast_enabled()), ('cpu', torch.is_autocast_cpu_enabled())] if on]
+
+
+def to_float32(x):
+    if torch.is_tensor(x):
+        return x.float() if x.is_floating_point() else x
+    if isinstance(x, (list, tuple)):
+        return type(x)(to_float32(i) for i in x)
+    if isinstance(x, dict):
+        return {k: to_float32(v) for k, v in x.items()}
+    return x
+
+
+def float32_forward(function):
+    """Run function with autocast disabled and its floating point tensor args in fp32, for losses that
+    lose precision / overflow in fp16 or bf16. A plain call outside autocast."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        devices = autocast_devices()
+        if not devices:
+            return function(*args, **kwargs)
+        with contextlib.ExitStack() as stack:
+            for device in devices:
+                stack.enter_context(torch.autocast(device, enabled=False))
+            return function(*to_float32(args), **to_float32(kwargs))
+    return wrapper
 
 
 def label_edge_prediction(label):
@@ -69,8 +121,8 @@ def set_seed(seed=1024):
 def visualize_all(in_pred, in_gt, path):
     for kk in range(in_pred.shape[0]):
         pred, gt = in_pred[kk, :, :, :], in_gt[kk, :, :, :]
-        pred = (pred.detach().cpu().numpy().squeeze()*255.0).astype(np.uint8)
-        gt = (gt.detach().cpu().numpy().squeeze()*255.0).astype(np.uint8)
+        pred = (pred.detach().float().cpu().numpy().squeeze()*255.0).astype(np.uint8)
+        gt = (gt.detach().float().cpu().numpy().squeeze()*255.0).astype(np.uint8)
         cat_img = cv2.hconcat([pred, gt])
         save_path = path + '/vis_temp/'   
         # Save vis images this temp folder, based on this experiment's folder.
@@ -85,7 +137,7 @@ def visualize_list(input_list, path):
         show_list = []
         for i in input_list:
             tmp = i[kk, :, :, :]
-            tmp = (tmp.detach().cpu().numpy().squeeze()*255.0).astype(np.uint8)
+            tmp = (tmp.detach().float().cpu().numpy().squeeze()*255.0).astype(np.uint8)
             show_list.append(tmp)
         cat_img = cv2.hconcat(show_list)
         save_path = path + '/vis_temp/'   
@@ -96,6 +148,160 @@ def visualize_list(input_list, path):
         cv2.imwrite(save_path + name, cat_img)
 
 
+class RunningStats(object):
+    """Per-pixel Welford mean / variance over stochastic samples, merged a batch of draws at a time.
+
+    update() takes (B, k, ...) samples, the k draws of every image are folded in with the parallel
+    (Chan et al.) form of Welford's update, in float32 on the samples' device.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, samples):
+        samples = samples.float()
+        k = samples.shape[1]
+        mean_b = samples.mean(1)
+        m2_b = ((samples - mean_b.unsqueeze(1)) ** 2).sum(1)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = k, mean_b, m2_b
+            return
+        count = self.count + k
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * (k / count)
+        self.m2 = self.m2 + m2_b + delta ** 2 * (self.count * k / count)
+        self.count = count
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def entropy(self):
+        # binary predictive entropy of the mean saliency, in [0, ln 2]
+        p = self.mean
+        return -(p * torch.log(p.clamp(min=1e-8)) + (1 - p) * torch.log((1 - p).clamp(min=1e-8)))
+
+
+class TrainingVisualizer(object):
+    """Rate-limited training visualization, replaces visualize_list on every step.
+
+    A step is written once `every_steps` steps or `every_seconds` seconds (0 disables either) have passed
+    since the last one: its maps are copied off the device without blocking and a background thread waits
+    for the copy, then writes the side-by-side PNGs of visualize_list, or TensorBoard images when a
+    SummaryWriter is given. Other steps return at once, no host sync and no I/O.
+    """
+    def __init__(self, log_path, every_steps=100, every_seconds=0, summary_writer=None):
+        self.save_path = os.path.join(log_path, 'vis_temp')
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.summary_writer = summary_writer
+        self.last_step, self.last_time = None, time.time()
+        self.error = None
+        self.pending = queue.Queue(maxsize=2)   # a slow disk drops visualizations instead of stalling training
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def due(self, step):
+        if self.last_step is None:
+            return True
+        if self.every_steps > 0 and step - self.last_step >= self.every_steps:
+            return True
+        return self.every_seconds > 0 and time.time() - self.last_time >= self.every_seconds
+
+    def __call__(self, result_list, step):
+        if not self.due(step) or self.pending.full():
+            return
+        self.last_step, self.last_time = step, time.time()
+        maps = torch.cat([x.detach()[:, :1].float() for x in result_list], dim=3)   # (B, 1, H, W * len)
+        ready = None
+        if maps.is_cuda:
+            maps = torch.empty(maps.shape, pin_memory=True).copy_(maps, non_blocking=True)
+            ready = torch.cuda.Event()
+            ready.record()
+        else:
+            maps = maps.clone()
+        self.pending.put((maps, ready, step))
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            maps, ready, step = item
+            try:
+                if ready is not None:
+                    ready.synchronize()
+                self._write(maps.clamp(0, 1), step)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, maps, step):
+        if self.summary_writer is not None:
+            self.summary_writer.add_images('train/prediction_gt', maps, step)
+            return
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path)
+        for kk, cat_img in enumerate((maps[:, 0] * 255.0).byte().numpy()):
+            cv2.imwrite(os.path.join(self.save_path, '{:02d}_cat.png'.format(kk)), cat_img)
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncImageWriter(object):
+    """cv2.imwrite on a thread pool, cv2 releases the GIL while encoding so PNGs compress in parallel.
+
+    At most `max_pending` images are queued, write() blocks beyond that (backpressure). Use it as a
+    context manager, or call close(), to flush the queue and re-raise failed writes.
+    """
+    def __init__(self, num_threads=4, max_pending=32):
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.wait_time = 0.0     # caller blocked on a full queue or on flush
+        self.encode_time = 0.0   # summed over the writer threads
+
+    def write(self, path, image):
+        start = time.time()
+        self.slots.acquire()
+        self.wait_time += time.time() - start
+        self.futures.append(self.pool.submit(self._write, path, image))
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+
+    def _write(self, path, image):
+        try:
+            start = time.time()
+            if not cv2.imwrite(path, image):
+                raise IOError('cv2.imwrite failed for {}'.format(path))
+            with self.lock:
+                self.encode_time += time.time() - start
+        finally:
+            self.slots.release()
+
+    def flush(self):
+        start = time.time()
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        self.wait_time += time.time() - start
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def save_scripts(path, scripts_to_save=None):
     if not os.path.exists(os.path.join(path, 'scripts')):
         os.makedirs(os.path.join(path, 'scripts'))